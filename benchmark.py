@@ -0,0 +1,247 @@
+### MULTI-AGENT WOLF - BENCHMARK
+# runs the real PlayerAgent/ChatRoomAgent/LLMInterfaceAgent FSMs headlessly on
+# the in-process bus, against a stand-in model server with a configurable
+# latency and token rate, for a sweep of bot counts. pacing sleeps are off, so
+# the numbers show what the agents themselves cost
+#
+# COMMAND-LINE ARGUMENTS:
+# --bots        - bot counts to sweep, e.g. --bots 1 5 10 20
+# --duration    - seconds measured per round, after --warmup
+# --latency     - the stand-in's time to first token, in seconds
+# --token-rate  - the stand-in's tokens per second
+# --output      - where the JSON results go
+################################################################################
+from player import PlayerAgent
+from chatroom import ChatRoomAgent
+from llminterface import LLMInterfaceAgent
+from chatlog import decode_entries, encode_entries
+from bus import in_process, BUS
+from aiohttp import web
+from datetime import datetime, timezone
+import argparse
+import resource
+import os
+import logging
+import asyncio
+import spade
+import json
+import time
+
+### SETTINGS
+DEFAULT_BOTS = [1, 2, 4, 8]
+DEFAULT_DURATION = 30
+DEFAULT_WARMUP = 5
+DEFAULT_LATENCY = 0.5
+DEFAULT_TOKEN_RATE = 50
+DEFAULT_TOKENS = 20
+DEFAULT_PORT = 8099
+DEFAULT_OUTPUT = "benchmark_results.json"
+LAG_INTERVAL = 0.05
+RSS_INTERVAL = 0.5
+ROOM = "village@localhost"
+
+### PERCENTILE
+# nearest-rank, good enough for a report
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None
+    }
+
+### MOCKLLMSERVER
+# answers /v1/chat/completions like an OpenAI-compatible server would, after
+# sleeping for latency + tokens / token_rate
+class MockLLMServer:
+    def __init__(self, port, latency, token_rate, tokens):
+        self.port = port
+        self.latency = latency
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.requests = 0
+        self.runner = None
+
+    async def completions(self, request):
+        body = await request.json()
+        self.requests += 1
+        await asyncio.sleep(self.latency + self.tokens / self.token_rate)
+
+        prompt_tokens = sum(len(str(msg.get("content", "")).split()) for msg in body["messages"])
+        return web.json_response({
+            "id": f"mock-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": " ".join(["word"] * self.tokens)}
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": self.tokens,
+                "total_tokens": prompt_tokens + self.tokens
+            }
+        })
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.completions)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "localhost", self.port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+### PROBE
+# watches the bus: a bot's query to its interface starts the clock, and its 
+# next post to the room stops it
+class Probe:
+    def __init__(self):
+        self.prompted = {}
+        self.latencies = []
+        self.recording = False
+
+    def __call__(self, msg):
+        sender = str(msg.sender).split("/")[0]
+        performative = msg.get_metadata("performative")
+        if performative == "query" and str(msg.to.bare()) != ROOM:
+            self.prompted[sender] = time.monotonic()
+        elif performative == "inform" and str(msg.to.bare()) == ROOM:
+            started = self.prompted.pop(sender, None)
+            if started is not None and self.recording:
+                self.latencies.append(time.monotonic() - started)
+
+### LAGMONITOR
+# how late the event loop wakes up from a short sleep
+async def monitor_lag(lags):
+    while True:
+        before = time.monotonic()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(time.monotonic() - before - LAG_INTERVAL)
+
+### CURRENT_RSS_KB
+# the process's resident set right now. ru_maxrss would be the high-water mark
+# of the whole run, so every round after the biggest would just repeat it. 
+# falls back on that where there's no /proc
+def current_rss_kb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# samples the resident set, so a round's own peak can be reported
+async def monitor_rss(samples):
+    while True:
+        samples.append(current_rss_kb())
+        await asyncio.sleep(RSS_INTERVAL)
+
+### RUN_ROUND
+async def run_round(num_bots, args):
+    Room, Interface, Player = map(in_process, (ChatRoomAgent, LLMInterfaceAgent, PlayerAgent))
+
+    room = Room(ROOM, "village", "Village")
+    ai = Interface("ai@localhost", "ai", base_url=f"http://localhost:{args.port}/v1", cache_size=0)
+    bots = [Player(f"bot{i}@localhost", f"bot{i}", "ai@localhost", wait_period=0, wait_variance=0)
+            for i in range(1, num_bots + 1)]
+
+    probe = Probe()
+    BUS.taps.append(probe)
+    lags = []
+    lag_task = asyncio.create_task(monitor_lag(lags))
+    rss_before = current_rss_kb()
+    rss_samples = []
+    rss_task = asyncio.create_task(monitor_rss(rss_samples))
+
+    for agent in [room, ai] + bots:
+        await agent.start()
+
+    await asyncio.sleep(args.warmup)
+    probe.recording = True
+    lags.clear()
+    delivered, posted = BUS.delivered, len(room.chat_log)
+    started = time.monotonic()
+
+    await asyncio.sleep(args.duration)
+
+    elapsed = time.monotonic() - started
+    delivered, posted = BUS.delivered - delivered, len(room.chat_log) - posted
+    rss_after = current_rss_kb()
+    lag_task.cancel()
+    rss_task.cancel()
+    BUS.taps.remove(probe)
+    for agent in bots + [ai, room]:
+        await agent.stop()
+
+    sample = [entry["content"] for entry in decode_entries(encode_entries(room.chat_log[-3:]))]
+    return {
+        "bots": num_bots,
+        "seconds": elapsed,
+        "bus_messages_per_sec": delivered / elapsed,
+        "chat_posts_per_sec": posted / elapsed,
+        "prompt_to_post_latency": summarize(probe.latencies),
+        "event_loop_lag": summarize(lags),
+        "rss_kb": rss_after,
+        "rss_growth_kb": rss_after - rss_before,
+        "peak_rss_kb": max(rss_samples + [rss_after]),
+        "sample": sample
+    }
+
+### ARGUMENTS
+def parse_args():
+    parser = argparse.ArgumentParser(description="Multi Agent Wolf benchmark")
+    parser.add_argument("--bots", type=int, nargs="+", default=DEFAULT_BOTS)
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION)
+    parser.add_argument("--warmup", type=float, default=DEFAULT_WARMUP)
+    parser.add_argument("--latency", type=float, default=DEFAULT_LATENCY)
+    parser.add_argument("--token-rate", type=float, default=DEFAULT_TOKEN_RATE)
+    parser.add_argument("--tokens", type=int, default=DEFAULT_TOKENS)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    return parser.parse_args()
+
+### MAIN
+async def main():
+    args = parse_args()
+    server = MockLLMServer(args.port, args.latency, args.token_rate, args.tokens)
+    await server.start()
+
+    rounds = []
+    for num_bots in args.bots:
+        result = await run_round(num_bots, args)
+        rounds.append(result)
+        latency = result["prompt_to_post_latency"]
+        print(f"{num_bots:>4} bots: {result['chat_posts_per_sec']:.2f} posts/s, "
+              f"{result['bus_messages_per_sec']:.1f} msgs/s, "
+              f"p50 {latency['p50']} p99 {latency['p99']}, "
+              f"lag max {result['event_loop_lag']['max']}, rss {result['rss_kb']} KB "
+              f"({result['rss_growth_kb']:+}, peak {result['peak_rss_kb']})", flush=True)
+
+    await server.stop()
+
+    results = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "settings": vars(args),
+        "mock_requests": server.requests,
+        "rounds": rounds
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {args.output}")
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        level=logging.WARNING
+    )
+    spade.run(main())
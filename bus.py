@@ -0,0 +1,112 @@
+from spade.behaviour import FSMBehaviour
+import logging
+import asyncio
+
+### MESSAGEBUS
+# an in-process stand-in for the XMPP server. agents attached to the bus hand
+# their spade Messages to a queue, and the bus dispatches them to the receiving
+# agent, which matches them against its behaviours' templates exactly as if 
+# they'd come off the wire. for single-host games and tests, so nothing needs 
+# an ejabberd running
+#
+# ATTRIBUTES
+# agents        - bare JID -> attached agent
+# queue         - messages waiting for delivery
+# taps          - callables that get to see every message sent, for measuring
+class MessageBus:
+    def __init__(self):
+        self.agents = {}
+        self.queue = None
+        self.pump_task = None
+        self.delivered = 0
+        self.taps = []
+
+    def attach(self, agent):
+        self.agents[str(agent.jid.bare())] = agent
+        if self.pump_task is None or self.pump_task.done():
+            self.queue = asyncio.Queue()
+            self.pump_task = asyncio.create_task(self.pump())
+
+    def detach(self, agent):
+        self.agents.pop(str(agent.jid.bare()), None)
+        if not self.agents and self.pump_task is not None:
+            self.pump_task.cancel()
+            self.pump_task = None
+
+    def has(self, jid):
+        return str(jid.bare()) in self.agents
+
+    async def send(self, msg):
+        for tap in self.taps:
+            tap(msg)
+        await self.queue.put(msg)
+
+    async def pump(self):
+        while True:
+            msg = await self.queue.get()
+            agent = self.agents.get(str(msg.to.bare()))
+            if agent is None:
+                logging.warning(f"MessageBus: nobody at {msg.to}, dropped")
+                continue
+            try:
+                agent.dispatch(msg)
+                self.delivered += 1
+            except Exception as e:
+                logging.error(f"MessageBus: delivering to {msg.to}: {e}")
+
+BUS = MessageBus()
+
+### BUSCONTAINER
+# wraps an agent's spade container so that Behaviour.send goes through the bus.
+# everything else is passed through to the real container
+class BusContainer:
+    def __init__(self, container, bus):
+        self._container = container
+        self._bus = bus
+
+    def __getattr__(self, name):
+        return getattr(self._container, name)
+
+    async def send(self, msg, behaviour):
+        if self._bus.has(msg.to):
+            await self._bus.send(msg)
+        else:
+            logging.warning(f"MessageBus: {msg.to} isn't on the bus, dropped")
+
+### INPROCESSAGENT
+# mixed in ahead of an agent class to run it on the bus instead of XMPP: 
+# start() skips connecting and registering, and just sets the agent up and 
+# starts its behaviours
+class InProcessAgent:
+    bus = BUS
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.container = BusContainer(self.container, self.bus)
+
+    async def start(self, auto_register=True):
+        self.bus.attach(self)
+        await self.setup()
+        self._alive.set()
+        for behaviour in self.behaviours:
+            if not behaviour.is_running:
+                behaviour.set_agent(self)
+                if isinstance(behaviour, FSMBehaviour):
+                    for state in behaviour.get_states().values():
+                        state.set_agent(self)
+                behaviour.start()
+
+    async def stop(self):
+        for behaviour in self.behaviours:
+            behaviour.kill()
+        self.bus.detach(self)
+        self._alive.clear()
+
+### IN_PROCESS
+# the bus-backed version of an agent class, e.g. in_process(PlayerAgent)
+IN_PROCESS_CLASSES = {}
+
+def in_process(cls):
+    if cls not in IN_PROCESS_CLASSES:
+        IN_PROCESS_CLASSES[cls] = type(f"InProcess{cls.__name__}", (InProcessAgent, cls), {})
+    return IN_PROCESS_CLASSES[cls]
@@ -0,0 +1,269 @@
+from collections import deque
+from array import array
+import logging
+import json
+import mmap
+import os
+
+### SETTINGS
+SEGMENT_SIZE = 256      # entries per segment
+MEMORY_SEGMENTS = 4     # segments kept in memory once there's a file to spill to
+
+DECODER = json.JSONDecoder()
+
+### ENCODE_ENTRY
+# the canonical encoded form of one chat entry: JSON bytes on a single line.
+# string bodies are always parsed and re-encoded, so whatever a sender put in
+# there, the log only ever holds one well-formed object per line. raises
+# ValueError for anything that isn't a JSON object
+def encode_entry(entry):
+    if isinstance(entry, str):
+        entry = json.loads(entry)
+    if not isinstance(entry, dict):
+        raise ValueError(f"chat entry must be an object, not {type(entry).__name__}")
+    return json.dumps(entry).encode()
+
+### ENCODE_ENTRIES
+# joins already-encoded entries into a JSON array, without touching them again.
+# one entry per line, so a reader can split them apart without decoding them 
+# (see messagestore.py)
+def encode_entries(encoded):
+    return "[" + b",\n".join(encoded).decode() + "]"
+
+### DECODE_ENTRIES
+# the other way around, one entry at a time, so a reader can start using the 
+# first entries before it's decoded the rest
+def decode_entries(body):
+    index = body.index("[") + 1
+    end = len(body)
+    while index < end:
+        while index < end and body[index] in " \t\r\n,":
+            index += 1
+        if index >= end or body[index] == "]":
+            return
+        entry, index = DECODER.raw_decode(body, index)
+        yield entry
+
+# a line of the backing file that decodes to an entry
+def valid_line(line):
+    try:
+        return isinstance(json.loads(line), dict)
+    except ValueError:
+        return False
+
+### CHATLOG
+# the chat history of a room, stored as fixed-size segments of encoded entries 
+# (see encode_entry), so they're serialized once and never again. the newest 
+# memory_segments live in memory, and with a path every entry is also appended
+# to a JSON-lines file, so older segments can be dropped from memory and read
+# back from disk (through mmap) when someone asks for them. without a path 
+# there's nowhere to spill to, so the oldest segments are simply forgotten:
+# the log keeps counting them, but only the newest memory_segments can be read
+# (from first_index on), and asking for anything older is an IndexError.
+# behaves like the list it replaces: len(), log[i] and log[index:] all work, 
+# and a slice only touches the entries it returns
+#
+# ARGUMENTS
+# path          - append-only backing file, recovered from if it exists
+# segment_size  - entries per segment
+# memory_segments - how many of the newest segments stay in memory
+# durable       - fsync after every append, for when a crash mustn't lose a line
+#
+# ATTRIBUTES
+# segments      - the in-memory segments, oldest first
+# first_segment - the segment number of segments[0], everything before it is
+#                 on disk, or gone if there's no file
+# offsets       - byte offset of every entry in the file
+class ChatLog:
+    def __init__(self, path=None, segment_size=SEGMENT_SIZE, 
+                 memory_segments=MEMORY_SEGMENTS, durable=False):
+        self.path = path
+        self.segment_size = segment_size
+        self.memory_segments = memory_segments
+        self.durable = durable
+
+        self.segments = deque()
+        self.first_segment = 0
+        self.length = 0
+        self.offsets = array('Q')
+        self.file = None
+        self.map = None
+
+        if path:
+            self.recover()
+
+    # rebuilds the offsets from the file and loads the newest segments back 
+    # into memory. a last line without its newline is a write a crash cut 
+    # short, and is cut off. a damaged line anywhere else is dropped on its 
+    # own by rewriting the file without it, and everything after it is kept
+    def recover(self):
+        self.file = open(self.path, "a+b")
+        self.file.seek(0)
+
+        position = 0
+        damaged = 0
+        for line in self.file:
+            if not line.endswith(b"\n"):
+                break
+            if valid_line(line):
+                self.offsets.append(position)
+            else:
+                damaged += 1
+            position += len(line)
+
+        if position != self.file.tell():
+            logging.warning(f"ChatLog: {self.path}: dropping a torn last line at byte {position}")
+            self.file.truncate(position)
+        if damaged:
+            logging.warning(f"ChatLog: {self.path}: dropping {damaged} damaged lines")
+            self.rewrite()
+        self.file.seek(0, os.SEEK_END)
+
+        self.length = len(self.offsets)
+        if self.length:
+            last_segment = (self.length - 1) // self.segment_size
+            self.first_segment = max(0, last_segment - self.memory_segments + 1)
+            start = self.first_segment * self.segment_size
+            for i, entry in enumerate(self.read_disk(start, self.length)):
+                if (start + i) % self.segment_size == 0:
+                    self.segments.append([])
+                self.segments[-1].append(entry)
+            logging.info(f"ChatLog: {self.path}: recovered {self.length} entries")
+
+    # swaps the file for a copy holding only its valid lines
+    def rewrite(self):
+        temp_path = self.path + ".tmp"
+        self.offsets = array('Q')
+        self.file.seek(0)
+        with open(temp_path, "wb") as temp:
+            for line in self.file:
+                if valid_line(line):
+                    self.offsets.append(temp.tell())
+                    temp.write(line)
+            temp.flush()
+            os.fsync(temp.fileno())
+        self.file.close()
+        os.replace(temp_path, self.path)
+        self.file = open(self.path, "a+b")
+
+    # takes an entry already run through encode_entry
+    def append(self, entry):
+        if self.file is not None:
+            self.offsets.append(self.file.tell())
+            self.file.write(entry + b"\n")
+            self.file.flush()
+            if self.durable:
+                os.fsync(self.file.fileno())
+
+        if not self.segments or len(self.segments[-1]) >= self.segment_size:
+            self.segments.append([])
+        self.segments[-1].append(entry)
+        self.length += 1
+
+        # spill: the oldest segment is safely on disk already, or there's no 
+        # disk and it's let go
+        if len(self.segments) > self.memory_segments:
+            self.segments.popleft()
+            self.first_segment += 1
+
+    # the oldest entry that can still be read
+    @property
+    def first_index(self):
+        if self.file is not None:
+            return 0
+        return self.first_segment * self.segment_size
+
+    # has an empty log without a path carry on from index, as if everything
+    # before it had been forgotten. index has to be where a segment starts,
+    # which first_index always is
+    def start_at(self, index):
+        if self.file is not None or self.length:
+            raise ValueError("only an empty log without a path can start part way")
+        if index % self.segment_size:
+            raise ValueError(f"{index} isn't the start of a segment")
+        self.first_segment = index // self.segment_size
+        self.length = index
+
+    # entries [start, stop) straight out of the file, none without one
+    def read_disk(self, start, stop):
+        if start >= stop or self.file is None:
+            return []
+
+        end = self.offsets[stop] if stop < len(self.offsets) else self.file.tell()
+        if self.map is None or len(self.map) < end:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self.map[self.offsets[start]:end].splitlines()
+
+    def read_memory(self, start, stop):
+        entries = []
+        while start < stop:
+            segment, offset = divmod(start, self.segment_size)
+            chunk = self.segments[segment - self.first_segment][offset:offset + stop - start]
+            entries.extend(chunk)
+            start += len(chunk)
+        return entries
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if step != 1:
+                return list(self[start:stop])[::step]
+        else:
+            if key < 0:
+                key += self.length
+            if not 0 <= key < self.length:
+                raise IndexError("chat log index out of range")
+            start, stop = key, key + 1
+
+        if start < self.first_index and start < stop:
+            raise IndexError(f"chat log entries before {self.first_index} were forgotten")
+
+        boundary = self.first_segment * self.segment_size
+        entries = self.read_disk(start, min(stop, boundary))
+        entries += self.read_memory(max(start, boundary), stop)
+        return entries if isinstance(key, slice) else entries[0]
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+### TESTING
+if __name__ == "__main__":
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "village.log")
+
+    log = ChatLog(path, segment_size=2, memory_segments=2)
+    for i in range(7):
+        log.append(encode_entry({"role": "user", "content": str(i)}))
+    print(len(log), len(log.segments), log[0], log[-1])
+    print([entry["content"] for entry in decode_entries(encode_entries(log[3:]))])
+    log.close()
+
+    with open(path, "ab") as f:
+        f.write(b'{oops}\n')                # a damaged line
+        f.write(encode_entry({"role": "user", "content": "7"}) + b"\n")
+        f.write(b'{"role": "user", "con')   # a crash mid-write
+    log = ChatLog(path, segment_size=2, memory_segments=2)
+    print(len(log), [entry["content"] for entry in decode_entries(encode_entries(log[:]))])
+    log.close()
+
+    log = ChatLog(segment_size=2, memory_segments=2)
+    for i in range(7):
+        log.append(encode_entry({"role": "user", "content": str(i)}))
+    print(len(log), log.first_index, 
+          [entry["content"] for entry in decode_entries(encode_entries(log[log.first_index:]))])
+    print(list(decode_entries("[]")), encode_entry('{"role": "user", "content": "hi"}'))
+    log.close()
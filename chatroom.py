@@ -2,29 +2,43 @@ from spade.agent import Agent
 from spade.behaviour import CyclicBehaviour, OneShotBehaviour
 from spade.template import Template
 from spade.message import Message
-import json
-import logging
+from chatlog import ChatLog, encode_entry, encode_entries
+from metrics import REGISTRY, SIZE_BUCKETS
+from eventlog import get_logger
 
 MESSAGE_TIMEOUT = 300
 
+### METRICS
+LOG_SIZE = REGISTRY.gauge("wolf_room_log_entries", "entries in the room's chat log")
+QUERIES = REGISTRY.counter("wolf_room_queries_total", "chat log queries served")
+RESPONSE_BYTES = REGISTRY.histogram("wolf_room_response_bytes", "size of chat log responses and pushes", SIZE_BUCKETS)
+PUSHES = REGISTRY.counter("wolf_room_pushes_total", "messages pushed to subscribers")
+
 ### CHATROOMAGENT
 # manages a virtual chatroom for players. stores chat messages in a log and 
 # responds to queries about the chat history.
 #
 # ARGUMENTS
 # room_name     - village/hideout, or day/night, but just "village" for now
+# log_path      - optional file the chat log is appended to, and recovered 
+#                 from after a restart
 #
 # ATTRIBUTES
-# chat_log      - holds all the chat history
+# chat_log      - holds all the chat history (see chatlog.py). without a 
+#                 log_path the oldest of it is forgotten, and anyone asking 
+#                 from before first_index gets what's left, with an "index"
+#                 saying where it starts so they can catch up their own
+# subscribers   - JIDs of players that get new messages pushed to them
+# stream_subscribers - the ones that also want replies as they're being typed
 class ChatRoomAgent(Agent):
-    def __init__(self, jid, password, room_name, **kwargs):
+    def __init__(self, jid, password, room_name, log_path=None, **kwargs):
         super().__init__(jid, password, **kwargs)
         self.room_name = room_name
-        self.chat_log = []
+        self.chat_log = ChatLog(log_path)
+        self.subscribers = set()
+        self.stream_subscribers = set()
+        self.logger = get_logger("room", self.name)
 
-    # for formatting
-    def log(self, source, message):
-        return f"{self.name}: {source}: {message}"
 
     ### GETMSGBEHAVIOUR
     # takes messages sent by agents and stores them
@@ -35,16 +49,22 @@ class ChatRoomAgent(Agent):
             try:
                 message = await self.receive(timeout=MESSAGE_TIMEOUT)
                 if message:
-                    logging.info(self.agent.log("GetMsgBehaviour", f"received message {message.body}"))
-                    data = json.loads(message.body)
+                    self.agent.logger.debug("GetMsgBehaviour: received message %s", message.body)
+                    try:
+                        entry = encode_entry(message.body)
+                    except ValueError as e:
+                        self.agent.logger.warning("GetMsgBehaviour: dropped a malformed message from %s: %s", message.sender, e)
+                        return
 
-                    self.agent.chat_log.append(data)
+                    self.agent.chat_log.append(entry)
+                    LOG_SIZE.set(len(self.agent.chat_log), room=self.agent.name)
+                    await self.agent.push(self, [entry], index=len(self.agent.chat_log) - 1)
                     
                 else:
-                    logging.debug(self.agent.log("GetMsgBehaviour", "timed out"))
+                    self.agent.logger.debug("GetMsgBehaviour: timed out")
 
             except Exception as e:
-                logging.error(self.agent.log("GetMsgBehaviour, receiving", e))
+                self.agent.logger.error("GetMsgBehaviour, receiving: %s", e)
 
     ### SERVECHATBEHAVIOUR
     # the behaviour called by other agents when they want to grab messages
@@ -57,32 +77,118 @@ class ChatRoomAgent(Agent):
       
                     index = int(request.body)  # Validate index
                     sender = str(request.sender.bare())
-                    logging.info(self.agent.log("ServeChatBehaviour", f"received request from {sender}"))
+                    self.agent.logger.debug("ServeChatBehaviour: received request from %s", sender)
 
                     # slice the chat log
+                    index = max(index, self.agent.chat_log.first_index)
                     new_messages = self.agent.chat_log[index:] if index < len(self.agent.chat_log) else []
-                    logging.info(self.agent.log("ServeChatBehaviour", f"new messages: {new_messages}"))
+                    self.agent.logger.debug("ServeChatBehaviour: %s new messages for %s", len(new_messages), sender)
                     response = Message(to=sender)
-                    response.body = json.dumps(new_messages)
+                    response.set_metadata("index", str(index))
+                    response.body = encode_entries(new_messages)
+                    QUERIES.inc(room=self.agent.name)
+                    RESPONSE_BYTES.observe(len(response.body), room=self.agent.name, kind="query")
                     await self.send(response)
 
                 else:
-                    logging.debug("ChatRoomAgent: ServeChatBehaviour: timeout, so quiet :()")
+                    self.agent.logger.debug("ServeChatBehaviour: timeout, so quiet :(")
             
             except Exception as e:
-                logging.error(self.agent.log("GetMsgBehaviour, receiving", e))
+                self.agent.logger.error("GetMsgBehaviour, receiving: %s", e)
+
+    # fans a list of encoded entries out to subscribers (or just the one 
+    # given). index is where the first of them sits in the log
+    async def push(self, behaviour, entries, index, to=None):
+        body = encode_entries(entries)
+        RESPONSE_BYTES.observe(len(body), room=self.name, kind="push")
+        for subscriber in ([to] if to else list(self.subscribers)):
+            PUSHES.inc(room=self.name)
+            message = Message(to=subscriber)
+            message.set_metadata("performative", "inform")
+            message.set_metadata("channel", "chat")
+            message.set_metadata("index", str(index))
+            message.body = body
+            await behaviour.send(message)
+
+    ### STREAMBEHAVIOUR
+    # a reply that's still being generated, sent along on the "stream" channel
+    # with a "stage" of partial (the text so far) or abort (it was given up). 
+    # it's passed straight on to the stream subscribers, and never logged: the
+    # finished message comes in as usual once it's done
+    class StreamBehaviour(CyclicBehaviour):
+        async def run(self):
+            try:
+                partial = await self.receive(timeout=MESSAGE_TIMEOUT)
+                if partial:
+                    sender = str(partial.sender.bare())
+                    for subscriber in list(self.agent.stream_subscribers):
+                        if subscriber == sender:
+                            continue
+                        message = Message(to=subscriber, thread=partial.thread)
+                        message.set_metadata("performative", "inform")
+                        message.set_metadata("channel", "stream")
+                        message.set_metadata("stage", partial.get_metadata("stage") or "partial")
+                        message.body = partial.body
+                        await self.send(message)
+            except Exception as e:
+                self.agent.logger.error("StreamBehaviour: %s", e)
+
+    ### SUBSCRIBEBEHAVIOUR
+    # players subscribe with the index they've read up to, get the backlog 
+    # from there in one go, and every new message is pushed to them after that.
+    # a "stream" flag signs them up for partial replies as well. a cancel 
+    # takes them off both lists
+    class SubscribeBehaviour(CyclicBehaviour):
+        async def run(self):
+            try:
+                request = await self.receive(timeout=MESSAGE_TIMEOUT)
+                if request:
+                    sender = str(request.sender.bare())
+
+                    if request.get_metadata("performative") == "cancel":
+                        self.agent.subscribers.discard(sender)
+                        self.agent.stream_subscribers.discard(sender)
+                        self.agent.logger.info("SubscribeBehaviour: %s unsubscribed", sender)
+                        return
+
+                    index = int(request.body or 0)
+                    self.agent.subscribers.add(sender)
+                    if request.get_metadata("stream"):
+                        self.agent.stream_subscribers.add(sender)
+                    self.agent.logger.info("SubscribeBehaviour: %s subscribed from %s", sender, index)
+
+                    index = max(index, self.agent.chat_log.first_index)
+                    backlog = self.agent.chat_log[index:]
+                    if backlog:
+                        await self.agent.push(self, backlog, index, to=sender)
+
+                else:
+                    self.agent.logger.debug("SubscribeBehaviour: timed out")
+
+            except Exception as e:
+                self.agent.logger.error("SubscribeBehaviour, receiving: %s", e)
 
     async def setup(self):
         msg_loop = self.GetMsgBehaviour()
         msg_template = Template()
         msg_template.metadata = {"performative": "inform"}
-        self.add_behaviour(msg_loop, msg_template)
+        stream_template = Template()
+        stream_template.metadata = {"channel": "stream"}
+        self.add_behaviour(msg_loop, msg_template & ~stream_template)
+        self.add_behaviour(self.StreamBehaviour(), stream_template)
 
         chat_serve = self.ServeChatBehaviour()
         serve_template = Template()
         serve_template.metadata = {"performative": "query"}
         self.add_behaviour(chat_serve, serve_template)
 
+        subscribe = self.SubscribeBehaviour()
+        subscribe_template = Template()
+        subscribe_template.metadata = {"performative": "subscribe"}
+        cancel_template = Template()
+        cancel_template.metadata = {"performative": "cancel"}
+        self.add_behaviour(subscribe, subscribe_template | cancel_template)
+
 ### TESTING
 if __name__ == "__main__":
     msg_list = ["a", "b", "c", "d", "e"]
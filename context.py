@@ -0,0 +1,135 @@
+from collections import deque
+
+### SETTINGS
+CHARS_PER_TOKEN = 4         # rough, but close enough for english chat
+MESSAGE_OVERHEAD = 4        # role and framing tokens per message
+DEFAULT_BUDGET = 1024       # tokens of chat memory, for models not listed below
+MODEL_BUDGETS = {
+    "llama3.1": 1536,
+    "llama3.2": 1536,
+    "mistral": 1024,
+    "phi3": 768,
+    "gemma2": 1024,
+}
+SUMMARY_TRIGGER = 200       # tokens of forgotten chat before the summary is redone
+RESET_FRACTION = 0.5        # with a stable prefix, how full the window is after a reset
+SUMMARY_WORDS = 80
+
+SUMMARY_PROMPT = (f"Summarize the chat so far for someone joining it, in at most {SUMMARY_WORDS} words. "
+                  "Keep who said what, and anything people might refer back to.")
+
+### ESTIMATE_TOKENS
+def estimate_tokens(message):
+    return len(str(message.get("content", ""))) // CHARS_PER_TOKEN + MESSAGE_OVERHEAD
+
+def budget_for(model):
+    return MODEL_BUDGETS.get(model.split(":")[0], DEFAULT_BUDGET)
+
+### CONTEXTWINDOW
+# a player's chat memory, sized by an estimated token budget instead of a 
+# message count, so a few long messages and a lot of short ones cost about the 
+# same. new messages go on the right, and once the budget is exceeded the 
+# oldest come off the left, without copying the rest. 
+# with summarize on, what falls off is kept aside until there's enough of it to
+# be worth folding into a rolling summary, which only ever gets the old summary 
+# and the new leftovers, never the whole history again.
+# with stable on, the window doesn't slide at all: it only grows until it hits 
+# the budget, then resets in one go down to reset_fraction of it (and the 
+# summary is redone then, and only then). between resets every prompt starts 
+# with the same bytes as the last one, so a server that caches prompts (like
+# ollama's KV cache) only has to process what's new
+#
+# ARGUMENTS
+# budget        - tokens the window may hold
+# summarize     - keep what falls off for the summary, instead of dropping it
+# stable        - grow append-only and reset in bulk, instead of sliding
+#
+# ATTRIBUTES
+# messages      - the window itself
+# tokens        - the estimated size of the window
+# summary       - everything older, condensed
+# folded        - messages that fell off since the summary was last updated
+# resets        - how many bulk resets there have been (stable only)
+class ContextWindow:
+    def __init__(self, budget=DEFAULT_BUDGET, summarize=True, stable=False):
+        self.budget = budget
+        self.summarize = summarize
+        self.stable = stable
+        self.resets = 0
+        self.messages = deque()
+        self.tokens = 0
+        self.summary = ""
+        self.folded = []
+        self.folded_tokens = 0
+
+    def append(self, message):
+        self.messages.append(message)
+        self.tokens += estimate_tokens(message)
+        self.trim()
+
+    def extend(self, messages):
+        for message in messages:
+            self.messages.append(message)
+            self.tokens += estimate_tokens(message)
+        self.trim()
+
+    # the newest message always stays, however long it is
+    def trim(self):
+        if self.tokens <= self.budget:
+            return
+
+        target = self.budget
+        if self.stable:
+            target = self.budget * RESET_FRACTION
+            self.resets += 1
+
+        while self.tokens > target and len(self.messages) > 1:
+            message = self.messages.popleft()
+            cost = estimate_tokens(message)
+            self.tokens -= cost
+            if self.summarize:
+                self.folded.append(message)
+                self.folded_tokens += cost
+
+    # a stable window redoes it straight after a reset, since the prefix is 
+    # changing anyway
+    def needs_summary(self):
+        if self.stable:
+            return self.summarize and bool(self.folded)
+        return self.summarize and self.folded_tokens >= SUMMARY_TRIGGER
+
+    # the prompt that folds the leftovers into the summary
+    def summary_request(self):
+        lines = "\n".join(str(message.get("content", "")) for message in self.folded
+                          if message.get("role") != "assistant")
+        previous = self.summary or "(nothing yet)"
+        return [
+            { "role": "system", "content": SUMMARY_PROMPT },
+            { "role": "user", "content": f"Summary so far: {previous}\n\nNew lines:\n{lines}" }
+        ]
+
+    # count is how many leftovers the summary covers, all of them by default.
+    # anything that fell off while it was being written waits for the next one
+    def apply_summary(self, summary, count=None):
+        count = len(self.folded) if count is None else count
+        self.summary = summary.strip()
+        self.folded = self.folded[count:]
+        self.folded_tokens = sum(estimate_tokens(message) for message in self.folded)
+
+    # goes between the system prompt and the window
+    def prefix(self):
+        if not self.summary:
+            return []
+        return [{ "role": "system", "content": f"Earlier in the chat: {self.summary}" }]
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+    def __repr__(self):
+        return f"ContextWindow({self.tokens}/{self.budget} tokens, {len(self.messages)} messages)"
@@ -0,0 +1,166 @@
+from collections import deque
+import logging
+import time
+import sys
+
+### SETTINGS
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(name)s - %(message)s"
+RING_SIZE = 1000        # recent events kept for when something goes wrong
+RATE_LIMIT = 5          # times the same message may be written per window
+RATE_WINDOW = 10        # seconds
+ROOT = "wolf"
+
+### GET_LOGGER
+# every part of the game logs under wolf.<category> (player, room, llm, sched,
+# ui), so each category's level can be set on its own. with an agent, lines are
+# prefixed with its name. messages should be %-style templates with arguments,
+# so nothing gets formatted unless it's actually going to be written:
+#   logger.info("GetChatState: chat index = %s", index)
+def get_logger(category, agent=None):
+    logger = logging.getLogger(f"{ROOT}.{category}")
+    if agent is None:
+        return logger
+    return AgentLogger(logger, {"agent": agent})
+
+### AGENTLOGGER
+# LoggerAdapter only calls process() once the level check has passed, so the 
+# prefix costs nothing for filtered lines
+class AgentLogger(logging.LoggerAdapter):
+    def process(self, msg, kwargs):
+        return f"{self.extra['agent']}: {msg}", kwargs
+
+### CATEGORYFILTER
+# per-category levels for what gets written, independent of what the ring
+# buffer collects
+class CategoryFilter(logging.Filter):
+    def __init__(self, level, categories):
+        super().__init__()
+        self.level = level
+        self.categories = {f"{ROOT}.{name}": lvl for name, lvl in categories.items()}
+
+    def filter(self, record):
+        return record.levelno >= self.categories.get(record.name, self.level)
+
+### RATELIMITFILTER
+# lets the same message template through at most `limit` times per window. 
+# when a template comes back after a quiet spell, a separate line first says
+# how many were held back. records are only ever let through or not, never 
+# changed, since other handlers (the ring buffer) hold the same ones. errors 
+# always get through
+class RateLimitFilter(logging.Filter):
+    def __init__(self, limit=RATE_LIMIT, window=RATE_WINDOW):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.seen = {} # (logger, template) -> [window start, count, suppressed]
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        entry = self.seen.get(key)
+        if entry is None or now - entry[0] >= self.window:
+            suppressed = entry[2] if entry else 0
+            self.seen[key] = [now, 1, 0]
+            if len(self.seen) > 10000:
+                self.seen.clear()
+            if suppressed:
+                logging.getLogger(record.name).log(record.levelno, "%d more like %r were suppressed", 
+                                                   suppressed, record.msg)
+            return True
+
+        entry[1] += 1
+        if entry[1] <= self.limit:
+            return True
+        entry[2] += 1
+        return False
+
+### RINGBUFFERHANDLER
+# holds on to the most recent records and only writes them out when an error
+# comes through, so the lead-up to a failure is there without paying for the
+# output the rest of the time. each record's message is filled in as it's 
+# stored, on a copy, so a dump shows what the arguments were then rather than
+# what they've become since (a context window keeps changing)
+class RingBufferHandler(logging.Handler):
+    def __init__(self, capacity=RING_SIZE, target=None):
+        super().__init__(logging.DEBUG)
+        self.records = deque(maxlen=capacity)
+        self.target = target or logging.StreamHandler(sys.stderr)
+
+    def emit(self, record):
+        stored = logging.makeLogRecord(record.__dict__)
+        stored.msg, stored.args = record.getMessage(), None
+        self.records.append(stored)
+        if record.levelno >= logging.ERROR:
+            self.dump()
+
+    def dump(self):
+        records, self.records = list(self.records), deque(maxlen=self.records.maxlen)
+        self.target.stream.write(f"--- last {len(records)} events ---\n")
+        for record in records:
+            self.target.handle(record)
+        self.target.stream.write("--- end of events ---\n")
+        self.target.flush()
+
+# accepts logging.INFO or "info" alike
+def to_level(level):
+    if isinstance(level, int):
+        return level
+    value = logging.getLevelName(str(level).upper())
+    if not isinstance(value, int):
+        raise ValueError(f"unknown log level {level}")
+    return value
+
+### CONFIGURE_LOGGING
+# sets up the wolf.* loggers: a console handler with per-category levels and 
+# rate limiting, plus the ring buffer
+#
+# ARGUMENTS
+# level         - default level written to the console
+# categories    - {category: level} overrides, e.g. {"player": logging.WARNING}
+# ring_size     - records kept for error dumps, 0 turns the ring off
+# ring_level    - the lowest level the ring collects. lower means every
+#                 record down to it gets created and formatted, even when
+#                 nothing is written, so DEBUG is for chasing a bug
+# rate_limit, rate_window - see RateLimitFilter
+def configure_logging(level=logging.INFO, categories=None, ring_size=RING_SIZE, 
+                      ring_level=logging.INFO, rate_limit=RATE_LIMIT, rate_window=RATE_WINDOW):
+    level = to_level(level)
+    categories = {name: to_level(lvl) for name, lvl in (categories or {}).items()}
+    formatter = logging.Formatter(LOG_FORMAT)
+
+    root = logging.getLogger(ROOT)
+    root.handlers.clear()
+    root.propagate = False
+
+    console = logging.StreamHandler()
+    console.setFormatter(formatter)
+    console.addFilter(CategoryFilter(level, categories))
+    if rate_limit:
+        console.addFilter(RateLimitFilter(rate_limit, rate_window))
+    root.addHandler(console)
+
+    lowest = min([level, *categories.values()])
+    if ring_size:
+        target = logging.StreamHandler(sys.stderr)
+        target.setFormatter(formatter)
+        root.addHandler(RingBufferHandler(ring_size, target))
+        lowest = min(lowest, ring_level)
+
+    # the logger stays open down to the lowest level anyone wants, and the 
+    # handlers decide what gets written
+    root.setLevel(lowest)
+
+### TESTING
+if __name__ == "__main__":
+    configure_logging(categories={"room": logging.WARNING}, ring_size=5, rate_limit=2, rate_window=0.5)
+    player = get_logger("player", "aiplayer1")
+    room = get_logger("room", "village")
+    for i in range(5):
+        player.info("GetChatState: chat index = %s", i)
+        room.info("ServeChatBehaviour: new messages: %s", i)
+    time.sleep(0.6)
+    player.info("GetChatState: chat index = %s", 99)
+    room.error("GetMsgBehaviour: something broke")
@@ -0,0 +1,72 @@
+import logging
+import asyncio
+import random
+import time
+
+### SETTINGS
+MAX_PARALLEL_STARTS = 8     # agents connecting/registering at the same time
+START_RETRIES = 4           # registration attempts before giving up on an agent
+RETRY_DELAY = 1             # base seconds between attempts, doubled each time
+
+### START_AGENT
+# logs an agent in, only registering the account if logging in fails (so 
+# accounts from earlier runs are reused instead of re-registered). ejabberd
+# throttles registrations, so those get retried with a jittered backoff.
+# returns how the agent got in and how long it took
+async def start_agent(agent, retries=START_RETRIES, delay=RETRY_DELAY):
+    started = time.monotonic()
+    try:
+        await agent.start(auto_register=False)
+        return "login", time.monotonic() - started
+    except Exception as e:
+        logging.debug(f"launcher: {agent.jid}: login failed, registering: {e}")
+
+    for attempt in range(retries):
+        try:
+            await agent.start(auto_register=True)
+            return "registered", time.monotonic() - started
+        except Exception as e:
+            if attempt == retries - 1:
+                raise
+            backoff = delay * 2 ** attempt * random.uniform(0.5, 1.5)
+            logging.warning(f"launcher: {agent.jid}: start failed ({e}), retrying in {backoff:.1f}s")
+            await asyncio.sleep(backoff)
+
+### START_AGENTS
+# starts a group of agents concurrently, at most max_parallel at once, and 
+# reports per-agent timing. an agent that can't start is logged and left out 
+# of the result instead of taking the rest down with it
+#
+# RETURNS
+# {jid: (how, seconds)} for every agent that started
+async def start_agents(agents, max_parallel=MAX_PARALLEL_STARTS):
+    slots = asyncio.Semaphore(max_parallel)
+    started = time.monotonic()
+
+    async def bounded(agent):
+        async with slots:
+            return await start_agent(agent)
+
+    results = await asyncio.gather(*(bounded(agent) for agent in agents), 
+                                   return_exceptions=True)
+
+    timings = {}
+    for agent, result in zip(agents, results):
+        if isinstance(result, BaseException):
+            logging.error(f"launcher: {agent.jid}: could not start: {result}")
+        else:
+            timings[str(agent.jid)] = result
+            logging.info(f"launcher: {agent.jid}: {result[0]} in {result[1]:.2f}s")
+
+    logging.info(f"launcher: {len(timings)}/{len(agents)} agents up in "
+                 f"{time.monotonic() - started:.2f}s")
+    return timings
+
+### STOP_AGENTS
+# the same, in reverse, without the bound since stopping is cheap
+async def stop_agents(agents):
+    results = await asyncio.gather(*(agent.stop() for agent in agents), 
+                                   return_exceptions=True)
+    for agent, result in zip(agents, results):
+        if isinstance(result, BaseException):
+            logging.error(f"launcher: {agent.jid}: could not stop: {result}")
@@ -0,0 +1,149 @@
+from collections import OrderedDict
+import threading
+import hashlib
+import asyncio
+import logging
+import sqlite3
+import json
+import time
+
+### SETTINGS
+CACHE_SIZE = 256        # completions held in memory
+CACHE_TTL = 600         # seconds before a completion is considered stale
+
+### RESPONSECACHE
+# sits in front of the model so repeated contexts (a quiet room full of filler
+# lines) come back instantly instead of costing another generation. the key is
+# a hash of the model name and the message list, normalized so that whitespace
+# and case differences don't count as a new context. entries are evicted 
+# least-recently-used past max_size, and dropped once they outlive the ttl.
+# it's off unless asked for: a cached answer is the same answer, so bots 
+# sharing a prompt (like the name prompt) would all get the same one.
+# the sqlite file is only touched from a worker thread by lookup and store,
+# so the event loop never waits on the disk
+#
+# ARGUMENTS
+# max_size      - the most entries kept in memory
+# ttl           - seconds an entry stays valid
+# path          - optional sqlite file backing the cache across restarts
+#
+# ATTRIBUTES
+# hits, misses  - counters, for judging whether the cache is earning its keep
+class ResponseCache:
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL, path=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (expires, payload)
+        self.hits = 0
+        self.misses = 0
+
+        self.db = None
+        self.db_lock = threading.Lock()
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS responses "
+                            "(key TEXT PRIMARY KEY, expires REAL, payload TEXT)")
+            self.db.execute("DELETE FROM responses WHERE expires < ?", (time.time(),))
+            self.db.commit()
+
+    # hash of the model and the normalized message list
+    @staticmethod
+    def make_key(model, messages):
+        normalized = [
+            (msg.get("role", ""), " ".join(str(msg.get("content", "")).split()).casefold())
+            for msg in messages
+        ]
+        blob = json.dumps([model, normalized], separators=(",", ":"))
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    # returns the stored payload, or None on a miss
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None and self.db is not None:
+            entry = self.read(key)
+        return self.found(key, entry)
+
+    def put(self, key, payload):
+        entry = (time.time() + self.ttl, payload)
+        self.remember(key, entry)
+        if self.db is not None:
+            self.write(key, entry)
+
+    # get and put for the event loop, with the disk work done in a thread
+    async def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None and self.db is not None:
+            entry = await asyncio.to_thread(self.read, key)
+        return self.found(key, entry)
+
+    async def store(self, key, payload):
+        entry = (time.time() + self.ttl, payload)
+        self.remember(key, entry)
+        if self.db is not None:
+            await asyncio.to_thread(self.write, key, entry)
+
+    # counts the lookup, and keeps or drops what the disk gave back
+    def found(self, key, entry):
+        if entry is None or entry[0] < time.time():
+            if entry is not None:
+                self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+        self.remember(key, entry)
+        self.hits += 1
+        return entry[1]
+
+    # disk only, expired rows are deleted rather than returned
+    def read(self, key):
+        with self.db_lock:
+            row = self.db.execute("SELECT expires, payload FROM responses WHERE key = ?", 
+                                  (key,)).fetchone()
+            if row and row[0] < time.time():
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.db.commit()
+                return None
+            return row
+
+    def write(self, key, entry):
+        with self.db_lock:
+            try:
+                self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", 
+                                (key, *entry))
+                self.db.commit()
+            except sqlite3.Error as e:
+                logging.error(f"ResponseCache: writing to disk: {e}")
+
+    # memory only, with LRU eviction
+    def remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits, 
+            "misses": self.misses, 
+            "size": len(self.entries),
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+    def close(self):
+        if self.db is not None:
+            with self.db_lock:
+                self.db.close()
+                self.db = None
+
+### TESTING
+if __name__ == "__main__":
+    cache = ResponseCache(max_size=2, ttl=1)
+    a = ResponseCache.make_key("llama3.1", [{"role": "user", "content": "Hello  there"}])
+    b = ResponseCache.make_key("llama3.1", [{"role": "user", "content": "hello there "}])
+    print(a == b)
+    cache.put(a, "hi")
+    print(cache.get(b))
+    time.sleep(1.1)
+    print(cache.get(a))
+    print(cache.stats())
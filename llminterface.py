@@ -2,89 +2,794 @@ from spade.behaviour import CyclicBehaviour, OneShotBehaviour
 from spade.agent import Agent
 from spade.template import Template
 from spade.message import Message
+from spade.behaviour import PeriodicBehaviour
 from asyncio import sleep
-from openai import OpenAI
+from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletion
+from llmcache import ResponseCache, CACHE_TTL
+from metrics import REGISTRY
+from eventlog import get_logger
+from collections import deque
 import logging
+import asyncio
 import spade
+import itertools
+import random
+import heapq
 import json
-
-import logging
+import time
+import uuid
 
 LISTEN_TIMEOUT = 10
+MAX_CONCURRENT = 4
+BATCH_WINDOW = 0.25     # seconds to wait for more prompts to join a batch, when every slot is busy
+MAX_BATCH = 8
+DEFAULT_BASE_URL = 'http://localhost:11434/v1'
+DRAIN_TIMEOUT = 120     # a worker sitting on a request this long is drained
+DRAIN_COOLDOWN = 60     # how long a drained worker is left alone
+KEEP_ALIVE = None       # how long ollama should keep the model loaded (e.g. "30m"). off
+                        # by default, servers that reject unknown fields fail the call
+MAX_QUEUE = 32          # prompts waiting on a worker before it starts refusing
+SERVICE_TIME = 5.0      # first guess at seconds per completion, for retry_after
+SERVICE_SMOOTHING = 0.2 # how quickly that guess follows the real thing
+STREAM_INTERVAL = 0.15  # seconds of tokens coalesced into one streamed chunk
+STREAM_CHUNK = 48       # characters that send a chunk early
+# every attempt plus the backoff between them has to fit in a player's 
+# PROMPT_TIMEOUT (300s), or the player gives up on an answer still coming
+REQUEST_TIMEOUT = 80    # seconds one attempt at a completion may take, streamed or not
+RETRIES = 2             # further attempts, on the next healthy backend
+RETRY_DELAY = 1         # base seconds between attempts, doubled each time
+BACKEND_COOLDOWN = 30   # seconds a failed backend goes to the back of the line
+LATENCY_WINDOW = 200    # recent completion times the hedge percentile is taken over
+HEDGE_SAMPLES = 20      # completions seen before hedging starts
+
+### PRIORITIES
+# sent by players as "priority" metadata, lower goes first. a "deadline" 
+# (epoch seconds) says when the sender stops waiting for the answer. "stream"
+# asks for the reply in chunks as it's generated, on the "stream" channel,
+# ahead of the usual full reply
+PRIORITY_NAME = 0       # a player can't do anything until it has a name
+PRIORITY_REPLY = 1      # answering chat that just came in
+PRIORITY_IDLE = 2       # breaking a silence
+PRIORITY_SUMMARY = 3    # housekeeping, can always wait
+DEFAULT_PRIORITY = PRIORITY_REPLY
+
+logger = get_logger("llm")
+
+### METRICS
+QUEUE_SECONDS = REGISTRY.histogram("wolf_llm_queue_seconds", "time from a prompt arriving to its generation starting")
+GENERATION_SECONDS = REGISTRY.histogram("wolf_llm_generation_seconds", "time spent waiting on the model")
+REQUESTS = REGISTRY.counter("wolf_llm_requests_total", "completions by outcome")
+PROMPT_TOKENS = REGISTRY.counter("wolf_llm_prompt_tokens_total", "prompt tokens reported by the model server")
+COMPLETION_TOKENS = REGISTRY.counter("wolf_llm_completion_tokens_total", "completion tokens reported by the model server")
+CACHE_LOOKUPS = REGISTRY.counter("wolf_llm_cache_lookups_total", "response cache lookups by result")
+QUEUE_DEPTH = REGISTRY.gauge("wolf_llm_queue_depth", "prompts waiting for a free slot")
+BACKEND_ERRORS = REGISTRY.counter("wolf_llm_backend_errors_total", "failed or timed out attempts per backend")
+HEDGES = REGISTRY.counter("wolf_llm_hedges_total", "hedged requests by which one won")
+
+# the metadata players attach, for senders that don't the defaults apply
+def priority_of(prompt):
+    try:
+        return int(prompt.get_metadata("priority"))
+    except (TypeError, ValueError):
+        return DEFAULT_PRIORITY
+
+def expired(prompt, now):
+    return past_deadline(prompt.get_metadata("deadline"), now)
+
+def past_deadline(deadline, now):
+    try:
+        return float(deadline) < now
+    except (TypeError, ValueError):
+        return False
+
+# an answer on the prompt's thread. a "channel" (e.g. "draft") is echoed back,
+# so the sender can route it to the right behaviour
+def reply_to(prompt, performative):
+    message = Message(to=str(prompt.sender.bare()), thread=prompt.thread)
+    message.set_metadata("performative", performative)
+    if prompt.get_metadata("channel"):
+        message.set_metadata("channel", prompt.get_metadata("channel"))
+    return message
 
 ### LLM
 # holds some functions for promting the openAI chat completions API
 # defaults to running ollama on localhost
+# with more than one backend, the first that's healthy gets the request and 
+# the rest are fallbacks: a request that fails or times out is retried with a
+# jittered backoff, and the backend it failed on is skipped for a while. with
+# hedge, a request still going past that percentile of recent latencies gets
+# a duplicate on the next backend, and whichever finishes second is cancelled
 # 
 # ARGUMENTS
 # model         - the llm to power the ai, defaults to llama
+# base_url      - the model server, or a list of them in order of preference
+# cache         - optional ResponseCache checked before going to the model
+# keep_alive    - sent along so ollama keeps the model (and its prompt cache) 
+#                 loaded between turns, None to leave it to the server
+# options       - extra model options for the server, e.g. {"num_ctx": 4096}
+# timeout       - seconds one attempt may take
+# retries       - further attempts after the first fails
+# hedge         - latency percentile (e.g. 95) to hedge at, None not to
 class LLM:
-    def __init__(self, model = 'llama3.1'):
-        self.client = OpenAI(
-            base_url = 'http://localhost:11434/v1',
-            api_key='ollama'
-        )
+    def __init__(self, model = 'llama3.1', base_url = DEFAULT_BASE_URL, cache = None,
+                 keep_alive = KEEP_ALIVE, options = None, timeout = REQUEST_TIMEOUT,
+                 retries = RETRIES, hedge = None):
+        self.backends = [base_url] if isinstance(base_url, str) else list(base_url)
+        # retries and timeouts are handled here, not by the client
+        self.clients = [AsyncOpenAI(base_url = url, api_key='ollama', max_retries=0)
+                        for url in self.backends]
         self.model = model
+        self.cache = cache
+        self.timeout = timeout
+        self.retries = retries
+        self.hedge = hedge
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.down = {}      # backend index -> when it may be tried first again
+
+        # fields the openai client doesn't know about go in the request body
+        self.extra_body = {}
+        if keep_alive is not None:
+            self.extra_body["keep_alive"] = keep_alive
+        if options:
+            self.extra_body["options"] = options
+
+    # healthy backends in order of preference, then the ones that failed lately
+    def order(self):
+        now = time.monotonic()
+        indexes = range(len(self.clients))
+        return ([i for i in indexes if self.down.get(i, 0) <= now] + 
+                [i for i in indexes if self.down.get(i, 0) > now])
+
+    # how long to give the first request before hedging, None for not yet
+    def hedge_delay(self):
+        if self.hedge is None or len(self.clients) < 2 or len(self.latencies) < HEDGE_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge / 100))]
+
+    # one request to one backend, within the timeout. a completion's time goes
+    # into the hedge window, a stream's doesn't: create only waits for the 
+    # stream to open, which says nothing about how long a completion takes
+    async def attempt(self, index, context, **kwargs):
+        started = time.monotonic()
+        try:
+            response = await asyncio.wait_for(self.clients[index].chat.completions.create(
+                model=self.model,
+                messages=context,
+                extra_body=self.extra_body or None,
+                **kwargs
+            ), self.timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.down[index] = time.monotonic() + BACKEND_COOLDOWN
+            BACKEND_ERRORS.inc(backend=self.backends[index], error=type(e).__name__)
+            logger.warning("%s: %s failed: %r", self.model, self.backends[index], e)
+            raise
+        self.down.pop(index, None)
+        if not kwargs.get("stream"):
+            self.latencies.append(time.monotonic() - started)
+        return response
+
+    # the first backend in line, and a hedge on the second if it's slow. the
+    # loser is cancelled, which drops its connection so the server stops too
+    async def hedged(self, context):
+        order = self.order()
+        first = asyncio.create_task(self.attempt(order[0], context))
+        tasks = [first]
+        try:
+            delay = self.hedge_delay()
+            if delay is None:
+                return await first
+
+            done, _ = await asyncio.wait({first}, timeout=delay)
+            if done:
+                return first.result()
+
+            tasks.append(asyncio.create_task(self.attempt(order[1], context)))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        HEDGES.inc(backend=self.backends[order[0]], 
+                                   result="primary" if task is first else "hedge")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    # retries the whole thing with a jittered backoff, each time starting 
+    # from whichever backends are healthy by then
+    async def complete(self, context):
+        for attempt in range(self.retries + 1):
+            try:
+                return await self.hedged(context)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                backoff = RETRY_DELAY * 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.warning("%s: attempt %s failed (%r), retrying in %.1fs", 
+                               self.model, attempt + 1, e, backoff)
+                await asyncio.sleep(backoff)
 
     # expects a list of dictionaries
     async def prompt(self, context):
+        key = None
+        if self.cache is not None:
+            key = ResponseCache.make_key(self.model, context)
+            cached = await self.cache.lookup(key)
+            CACHE_LOOKUPS.inc(model=self.model, result="miss" if cached is None else "hit")
+            if cached is not None:
+                logger.debug("%s: cache hit %s", self.model, self.cache.stats())
+                return ChatCompletion.model_validate_json(cached)
 
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=context
-        )
-        logging.debug(f"{self.model}: {response}")
+        response = await self.complete(context)
+        logger.debug("%s: %s", self.model, response)
+
+        if key is not None:
+            await self.cache.store(key, response.model_dump_json())
         return response
 
+    # like prompt, but awaits on_delta with each piece of text as the model 
+    # generates it. cancelling closes the stream, so the server stops too.
+    # the pieces are put back together into the same ChatCompletion prompt 
+    # returns (and caches). it fails over to the next backend like prompt 
+    # does, but only until the first piece has gone out. it isn't hedged.
+    # the timeout covers the whole attempt, reading the stream included, so
+    # a server that stalls halfway through doesn't hold the slot forever
+    async def prompt_stream(self, context, on_delta):
+        key = None
+        if self.cache is not None:
+            key = ResponseCache.make_key(self.model, context)
+            cached = await self.cache.lookup(key)
+            CACHE_LOOKUPS.inc(model=self.model, result="miss" if cached is None else "hit")
+            if cached is not None:
+                response = ChatCompletion.model_validate_json(cached)
+                await on_delta(response.choices[0].message.content or "")
+                return response
+
+        parts = []
+        for attempt in range(self.retries + 1):
+            index = self.order()[0]
+            started = time.monotonic()
+            try:
+                stream = await self.attempt(index, context, stream=True, 
+                                            stream_options={"include_usage": True})
+                try:
+                    remaining = self.timeout - (time.monotonic() - started)
+                    usage = await asyncio.wait_for(self.read_stream(stream, parts, on_delta), 
+                                                   max(remaining, 0))
+                finally:
+                    await stream.close()
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if parts or attempt == self.retries:
+                    raise
+                self.down[index] = time.monotonic() + BACKEND_COOLDOWN
+                backoff = RETRY_DELAY * 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.warning("%s: stream attempt %s failed (%r), retrying in %.1fs", 
+                               self.model, attempt + 1, e, backoff)
+                await asyncio.sleep(backoff)
+
+        response = ChatCompletion.model_validate({
+            "id": f"stream-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": self.model,
+            "choices": [{"index": 0, "finish_reason": "stop", 
+                         "message": {"role": "assistant", "content": "".join(parts)}}],
+            "usage": usage.model_dump() if usage else None
+        })
+        logger.debug("%s: streamed %s", self.model, response)
+
+        if key is not None:
+            await self.cache.store(key, response.model_dump_json())
+        return response
+
+    # collects a stream's text into parts, passing each piece on as it comes.
+    # returns the usage the server sends at the end, if it does
+    async def read_stream(self, stream, parts, on_delta):
+        usage = None
+        async for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                await on_delta(chunk.choices[0].delta.content)
+        return usage
+
 ### LLMINTERFACEAGENT
 # the alternative to the user interface, which connects with a player agent
 # so that an LLM can interact with the game, instead of a human
 #
 # ARGUMENTS
 # model         - the llm to power the ai, also defaults to llama
+# max_concurrent - how many completions may be in flight at once
+# base_url      - the model server this interface talks to, or a list with
+#                 fallbacks after it
+# batch_window  - seconds to hold the first prompt while others join it, 
+#                 only when there's no free slot to send it to anyway
+# max_batch     - the most prompts collected into one batch
+# cache_size    - completions cached in memory, 0 (the default) for no cache
+# cache_ttl     - seconds a cached completion stays valid
+# cache_path    - optional sqlite file to keep the cache across restarts
+# keep_alive, options - passed through to the LLM
+# max_queue     - prompts held waiting for a slot, past that they're refused
+# timeout, retries, hedge - also passed through to the LLM
 class LLMInterfaceAgent(Agent):
-    def __init__(self, jid, password, model='llama3.1', **kwargs):
+    def __init__(self, jid, password, model='llama3.1', 
+                 max_concurrent=MAX_CONCURRENT, base_url=DEFAULT_BASE_URL, 
+                 batch_window=BATCH_WINDOW, max_batch=MAX_BATCH, 
+                 cache_size=0, cache_ttl=CACHE_TTL, cache_path=None, 
+                 keep_alive=KEEP_ALIVE, options=None, max_queue=MAX_QUEUE, 
+                 timeout=REQUEST_TIMEOUT, retries=RETRIES, hedge=None, **kwargs):
         super().__init__(jid, password, **kwargs)
-        self.llm = LLM(model)
+        cache = ResponseCache(cache_size, cache_ttl, cache_path) if cache_size > 0 else None
+        self.llm = LLM(model, base_url, cache, keep_alive, options, timeout, retries, hedge)
+        self.logger = get_logger("llm", self.name)
+        self.max_concurrent = max_concurrent
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_queue = max_queue
+        self.service_time = SERVICE_TIME
 
-   # for formatting
-    def log(self, source, message):
-        return f"{self.name}: {source}: {message}"
     
+    # a busy reply, so the sender can back off and try again later instead of
+    # waiting out its timeout. the estimate is how long the work ahead of it 
+    # would take at the recent pace
+    async def refuse(self, behaviour, prompt):
+        backlog = len(behaviour.heap) + len(behaviour.in_flight)
+        retry_after = max(1.0, round(self.service_time * backlog / self.max_concurrent, 1))
+        REQUESTS.inc(result="refused", agent=self.name)
+
+        message = reply_to(prompt, "refuse")
+        message.body = json.dumps({"reason": "busy", "retry_after": retry_after})
+        await behaviour.send(message)
+        self.logger.info("refuse: %s, retry after %ss", prompt.sender, retry_after)
+
+    # the sender gave up on a prompt: it's taken out of the queue, or out of
+    # its completion, which is stopped if nobody else is waiting on it
+    def cancel(self, sender, thread):
+        behaviour = self.prompt_behaviour
+        match = lambda prompt: str(prompt.sender.bare()) == sender and prompt.thread == thread
+
+        queued = [entry for entry in behaviour.heap if match(entry[3])]
+        if queued:
+            behaviour.heap = [entry for entry in behaviour.heap if not match(entry[3])]
+            heapq.heapify(behaviour.heap)
+
+        for task, prompts in list(behaviour.in_flight.items()):
+            prompts[:] = [prompt for prompt in prompts if not match(prompt)]
+            if not prompts:
+                task.cancel()
+        REQUESTS.inc(result="cancelled", agent=self.name)
+        self.logger.debug("cancel: %s %s", sender, thread)
+
     ### PROMPTBEHAVIOUR
     # prompts the LLM and returns its response as an assistant-type message
+    # prompts that turn up within batch_window of each other are collected 
+    # into one batch and admitted into a bounded priority queue (with a slot
+    # free, there's no waiting: the prompt goes out at once, along with any 
+    # that had already arrived). whenever a slot is free, the most urgent 
+    # prompt is taken off it, along with any identical ones, which are 
+    # coalesced into a single completion. name prompts never are: the same 
+    # personality asks the same thing, and each bot needs a name of its own.
+    # the rest go out together as parallel slots on the model server (e.g. 
+    # OLLAMA_NUM_PARALLEL), each in its own task so the event loop keeps 
+    # running while the model generates.
+    # when the queue is full, the least urgent prompt is refused, and prompts 
+    # whose sender has stopped waiting (past their deadline) are dropped 
+    # instead of being answered to nobody. dropped and failed prompts still 
+    # get a failure reply, so a dispatcher in between knows to stop tracking 
+    # them.
+    # prompts that ask to stream get the text in chunks while it's generated,
+    # at most one every STREAM_INTERVAL, then the full reply as usual
     class PromptBehaviour(CyclicBehaviour): 
+        async def on_start(self):
+            self.heap = []              # heap of (priority, arrival, received, prompt)
+            self.arrivals = itertools.count()
+            self.in_flight = {}         # task -> the prompts it's answering
+            self.notices = set()        # failure replies still being sent
+
+        # waits for one prompt, then sweeps up whatever else arrives within
+        # the window, up to max_batch. with a slot free the window is skipped,
+        # and only prompts already waiting are swept up. also returns when 
+        # the first one came in
+        async def collect(self):
+            prompt = await self.receive(timeout=LISTEN_TIMEOUT)
+            if not prompt:
+                return [], None
+
+            received = time.monotonic()
+            batch = [prompt]
+            busy = len(self.in_flight) >= self.agent.max_concurrent
+            deadline = time.monotonic() + (self.agent.batch_window if busy else 0)
+            while len(batch) < self.agent.max_batch:
+                remaining = deadline - time.monotonic()
+                prompt = await self.receive(timeout=remaining if remaining > 0 else None)
+                if not prompt:
+                    break
+                batch.append(prompt)
+
+            return batch, received
+
+        # queues a prompt, or refuses whichever is least urgent if that 
+        # would go past max_queue. equal priorities go first come, first served
+        async def admit(self, prompt, received):
+            entry = (priority_of(prompt), next(self.arrivals), received, prompt)
+            if len(self.heap) < self.agent.max_queue:
+                heapq.heappush(self.heap, entry)
+                return
+
+            worst = max(self.heap)
+            if entry < worst:
+                self.heap.remove(worst)
+                heapq.heapify(self.heap)
+                heapq.heappush(self.heap, entry)
+                prompt = worst[3]
+            await self.agent.refuse(self, prompt)
+
+        # starts as many completions as there are free slots
+        def pump(self):
+            now = time.time()
+            while self.heap and len(self.in_flight) < self.agent.max_concurrent:
+                _, _, received, prompt = heapq.heappop(self.heap)
+
+                # same context, same answer: everyone waiting on it goes along
+                same = []
+                if priority_of(prompt) != PRIORITY_NAME:
+                    same = [entry for entry in self.heap if entry[3].body == prompt.body]
+                if same:
+                    self.heap = [entry for entry in self.heap if entry[3].body != prompt.body]
+                    heapq.heapify(self.heap)
+
+                waiting = [prompt, *(entry[3] for entry in same)]
+                prompts = [p for p in waiting if not expired(p, now)]
+                dropped = [p for p in waiting if expired(p, now)]
+                if dropped:
+                    REQUESTS.inc(len(dropped), result="expired", agent=self.agent.name)
+                    self.agent.logger.debug("PromptBehaviour: dropped %s expired prompts", len(dropped))
+                    notice = asyncio.create_task(self.fail(dropped, "expired"))
+                    self.notices.add(notice)
+                    notice.add_done_callback(self.notices.discard)
+                if not prompts:
+                    continue
+
+                task = asyncio.create_task(self.answer(prompts, received))
+                self.in_flight[task] = prompts
+                task.add_done_callback(self.finished)
+            QUEUE_DEPTH.set(len(self.heap), agent=self.agent.name)
+
+        def finished(self, task):
+            self.in_flight.pop(task, None)
+            if not self.is_killed():
+                self.pump()
+
         async def run(self):
             try:
-                prompt = await self.receive(timeout=10)
-                if prompt:
-                    data = json.loads(prompt.body)
+                batch, received = await self.collect()
+            except Exception as e:
+                self.agent.logger.error("PromptBehaviour, receiving: %s", e)
+                return
+
+            if not batch:
+                self.agent.logger.debug("PromptBehaviour: timeout")
+                return
 
-                    # query the LLM
-                    response = await self.agent.llm.prompt(data)
-                    logging.debug(self.agent.log("PromptBehaviour, full response", response))
+            try:
+                for prompt in batch:
+                    await self.admit(prompt, received)
+            except Exception as e:
+                self.agent.logger.error("PromptBehaviour, admitting: %s", e)
+            self.agent.logger.debug("PromptBehaviour: batch of %s prompts, %s queued, %s in flight", 
+                                    len(batch), len(self.heap), len(self.in_flight))
+            self.pump()
 
-                    completion = {
-                        "role": "assistant", "content": response.choices[0].message.content
-                    }
-                    logging.info(self.agent.log("PromptBehaviour, return", completion))
-                    message = Message(to=str(prompt.sender.bare()))
-                    message.body = json.dumps(completion)
+        # tells everyone waiting on prompts that no answer is coming
+        async def fail(self, prompts, reason):
+            body = json.dumps({"reason": reason})
+            for prompt in prompts:
+                message = reply_to(prompt, "failure")
+                message.body = body
+                await self.send(message)
 
+        # sends what's been generated since the last chunk to everyone streaming
+        async def flush(self, prompts, pending):
+            if not pending:
+                return
+            body = json.dumps({"delta": "".join(pending)})
+            pending.clear()
+            for prompt in prompts:
+                if prompt.get_metadata("stream"):
+                    message = reply_to(prompt, "inform")
+                    message.set_metadata("channel", "stream")
+                    message.body = body
                     await self.send(message)
 
-                else:
-                    logging.debug(self.agent.log("PromptBehaviour", "timeout"))
+        # streams the completion to whoever asked for it, coalescing the 
+        # model's tokens into chunks
+        async def stream(self, data, prompts):
+            pending = []
+            last_flush = time.monotonic()
+
+            async def on_delta(text):
+                nonlocal last_flush
+                pending.append(text)
+                if (time.monotonic() - last_flush >= STREAM_INTERVAL
+                        or sum(map(len, pending)) >= STREAM_CHUNK):
+                    await self.flush(prompts, pending)
+                    last_flush = time.monotonic()
 
+            response = await self.agent.llm.prompt_stream(data, on_delta)
+            await self.flush(prompts, pending)
+            return response
+
+        # one completion, start to finish, sent to everyone who asked for it.
+        # prompts is shared with in_flight, so a cancelled one drops out of it
+        async def answer(self, prompts, received):
+            labels = {"agent": self.agent.name}
+            QUEUE_SECONDS.observe(time.monotonic() - received, **labels)
+            try:
+                data = json.loads(prompts[0].body)
+
+                # query the LLM
+                started = time.monotonic()
+                with GENERATION_SECONDS.time(**labels):
+                    if any(prompt.get_metadata("stream") for prompt in prompts):
+                        response = await self.stream(data, prompts)
+                    else:
+                        response = await self.agent.llm.prompt(data)
+                self.agent.service_time += SERVICE_SMOOTHING * (time.monotonic() - started - self.agent.service_time)
+                self.agent.logger.debug("PromptBehaviour, full response: %s", response)
+
+                if response.usage:
+                    PROMPT_TOKENS.inc(response.usage.prompt_tokens, **labels)
+                    COMPLETION_TOKENS.inc(response.usage.completion_tokens, **labels)
+                REQUESTS.inc(len(prompts), result="ok", **labels)
+
+                completion = {
+                    "role": "assistant", "content": response.choices[0].message.content
+                }
+                self.agent.logger.info("PromptBehaviour, return: %s", completion)
+                body = json.dumps(completion)
+
+                for prompt in prompts:
+                    message = reply_to(prompt, "inform")
+                    message.body = body
+                    await self.send(message)
+
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                logging.error(self.agent.log("PromptBehaviour, prompting", e))
-                # TODO: sending error messages back
+                REQUESTS.inc(len(prompts), result="error", **labels)
+                self.agent.logger.error("PromptBehaviour, prompting: %s", e)
+                await self.fail(prompts, "error")
+
+        async def on_end(self):
+            for task in list(self.in_flight):
+                task.cancel()
     
+    ### CANCELBEHAVIOUR
+    # takes cancels for prompts whose sender gave up
+    class CancelBehaviour(CyclicBehaviour):
+        async def run(self):
+            try:
+                cancel = await self.receive(timeout=LISTEN_TIMEOUT)
+                if cancel:
+                    self.agent.cancel(str(cancel.sender.bare()), cancel.thread)
+            except Exception as e:
+                self.agent.logger.error("CancelBehaviour: %s", e)
+
     async def setup(self):
-        prompt_behav = self.PromptBehaviour()
+        self.prompt_behaviour = self.PromptBehaviour()
         template = Template()
         template.set_metadata("performative", "query")
-        self.add_behaviour(prompt_behav, template)
+        self.add_behaviour(self.prompt_behaviour, template)
+
+        cancel_template = Template()
+        cancel_template.set_metadata("performative", "cancel")
+        self.add_behaviour(self.CancelBehaviour(), cancel_template)
+
+
+### LLMDISPATCHERAGENT
+# stands in front of a pool of LLMInterfaceAgents, so players keep talking to 
+# a single JID. every query goes to whichever worker has the fewest requests
+# outstanding, and the reply is relayed back to the player who asked.
+# a worker that sits on a request past drain_timeout is drained: it gets no
+# new work for a while, and whatever it was holding is cancelled there and 
+# handed to someone else, unless the player's deadline has passed, in which 
+# case it's just dropped. a failure from a worker goes straight back.
+# a worker that's too busy gets one other worker to try, after which the 
+# refusal goes back to the player
+#
+# ARGUMENTS
+# workers       - JIDs of the LLMInterfaceAgents in the pool
+# drain_timeout - seconds before a silent worker is considered slow or dead
+# drain_cooldown - seconds a drained worker is skipped before being retried
+#
+# ATTRIBUTES
+# outstanding   - worker -> {thread: (sender, thread, body, sent_at, metadata)}
+# refused       - threads a worker has already turned away once
+# routes        - thread -> the worker currently responsible for it
+# drained       - worker -> the time it may receive work again
+class LLMDispatcherAgent(Agent):
+    def __init__(self, jid, password, workers, drain_timeout=DRAIN_TIMEOUT,
+                 drain_cooldown=DRAIN_COOLDOWN, **kwargs):
+        super().__init__(jid, password, **kwargs)
+        self.workers = list(workers)
+        self.drain_timeout = drain_timeout
+        self.drain_cooldown = drain_cooldown
+        self.outstanding = {worker: {} for worker in self.workers}
+        self.routes = {}
+        self.drained = {}
+        self.refused = set()
+        self.logger = get_logger("llm", self.name)
+
+ 
+    # least-loaded worker that isn't drained, or least-loaded overall if 
+    # everyone is, since a slow answer beats no answer
+    def pick_worker(self, exclude=None):
+        now = time.monotonic()
+        candidates = [w for w in self.workers if w != exclude] or self.workers
+        live = [w for w in candidates if self.drained.get(w, 0) <= now]
+        return min(live or candidates, key=lambda w: len(self.outstanding[w]))
+
+    # hands a request to a worker and remembers who it belongs to. metadata
+    # is the priority, deadline and channel the player gave it
+    async def forward(self, behaviour, thread, sender, reply_thread, body, metadata, exclude=None):
+        worker = self.pick_worker(exclude)
+        self.outstanding[worker][thread] = (sender, reply_thread, body, time.monotonic(), metadata)
+        self.routes[thread] = worker
+
+        request = Message(to=worker, thread=thread, metadata=dict(metadata))
+        request.set_metadata("performative", "query")
+        request.body = body
+        await behaviour.send(request)
+        self.logger.debug("forward: %s -> %s (%s outstanding)", sender, worker, len(self.outstanding[worker]))
+
+    ### FORWARDBEHAVIOUR
+    # takes queries from players and passes them into the pool
+    class ForwardBehaviour(CyclicBehaviour):
+        async def run(self):
+            try:
+                prompt = await self.receive(timeout=LISTEN_TIMEOUT)
+                if prompt:
+                    metadata = {key: prompt.get_metadata(key) for key in ("priority", "deadline", "channel", "stream")
+                                if prompt.get_metadata(key) is not None}
+                    await self.agent.forward(self, uuid.uuid4().hex, str(prompt.sender.bare()),
+                                             prompt.thread, prompt.body, metadata)
+            except Exception as e:
+                self.agent.logger.error("ForwardBehaviour: %s", e)
+
+    ### RELAYBEHAVIOUR
+    # takes replies (and failures) from workers and passes them back to the
+    # player. late replies for requests that were already answered elsewhere
+    # are dropped,
+    # and a first refusal is retried on another worker. streamed chunks are
+    # passed on, and leave the request open for the full reply
+    class RelayBehaviour(CyclicBehaviour):
+        async def run(self):
+            try:
+                reply = await self.receive(timeout=LISTEN_TIMEOUT)
+                if reply and reply.get_metadata("channel") == "stream":
+                    worker = self.agent.routes.get(reply.thread)
+                    if worker is not None:
+                        sender, reply_thread = self.agent.outstanding[worker][reply.thread][:2]
+                        message = Message(to=sender, thread=reply_thread)
+                        message.set_metadata("performative", "inform")
+                        message.set_metadata("channel", "stream")
+                        message.body = reply.body
+                        await self.send(message)
+                    return
+
+                if reply:
+                    worker = self.agent.routes.pop(reply.thread, None)
+                    if worker is None:
+                        self.agent.logger.debug("RelayBehaviour: dropped late reply from %s", reply.sender)
+                        return
+
+                    sender, reply_thread, body, _, metadata = self.agent.outstanding[worker].pop(reply.thread)
+                    self.agent.drained.pop(str(reply.sender.bare()), None) # it's alive after all
+
+                    performative = reply.get_metadata("performative")
+                    if (performative == "refuse" and reply.thread not in self.agent.refused 
+                            and len(self.agent.workers) > 1):
+                        self.agent.refused.add(reply.thread)
+                        await self.agent.forward(self, reply.thread, sender, reply_thread, body, 
+                                                 metadata, exclude=worker)
+                        return
+                    self.agent.refused.discard(reply.thread)
+
+                    message = Message(to=sender, thread=reply_thread)
+                    message.set_metadata("performative", performative)
+                    if reply.get_metadata("channel"):
+                        message.set_metadata("channel", reply.get_metadata("channel"))
+                    message.body = reply.body
+                    await self.send(message)
+            except Exception as e:
+                self.agent.logger.error("RelayBehaviour: %s", e)
+
+    ### CANCELBEHAVIOUR
+    # passes a player's cancel on to whichever worker has the request
+    class CancelBehaviour(CyclicBehaviour):
+        async def run(self):
+            try:
+                cancel = await self.receive(timeout=LISTEN_TIMEOUT)
+                if not cancel:
+                    return
+                sender = str(cancel.sender.bare())
+                for worker, pending in self.agent.outstanding.items():
+                    for thread, request in list(pending.items()):
+                        if request[0] == sender and request[1] == cancel.thread:
+                            del pending[thread]
+                            self.agent.routes.pop(thread, None)
+                            message = Message(to=worker, thread=thread)
+                            message.set_metadata("performative", "cancel")
+                            await self.send(message)
+            except Exception as e:
+                self.agent.logger.error("CancelBehaviour: %s", e)
+
+    ### WATCHDOGBEHAVIOUR
+    # drains workers whose oldest request has gone stale
+    class WatchdogBehaviour(PeriodicBehaviour):
+        async def run(self):
+            now = time.monotonic()
+            for worker in self.agent.workers:
+                pending = self.agent.outstanding[worker]
+                if not pending:
+                    continue
+
+                oldest = min(sent_at for _, _, _, sent_at, _ in pending.values())
+                if now - oldest < self.agent.drain_timeout:
+                    continue
+
+                self.agent.logger.warning("WatchdogBehaviour: draining %s, %s requests taken back", worker, len(pending))
+                self.agent.drained[worker] = now + self.agent.drain_cooldown
+                self.agent.outstanding[worker] = {}
+                for thread, (sender, reply_thread, body, _, metadata) in pending.items():
+                    try:
+                        # a worker that's only slow would otherwise answer it as well
+                        cancel = Message(to=worker, thread=thread)
+                        cancel.set_metadata("performative", "cancel")
+                        await self.send(cancel)
+
+                        if past_deadline(metadata.get("deadline"), time.time()):
+                            self.agent.routes.pop(thread, None)
+                            self.agent.refused.discard(thread)
+                            self.agent.logger.debug("WatchdogBehaviour: dropped expired request from %s", sender)
+                            continue
+                        await self.agent.forward(self, thread, sender, reply_thread, body, metadata, exclude=worker)
+                    except Exception as e:
+                        self.agent.logger.error("WatchdogBehaviour: %s", e)
+
+    async def setup(self):
+        forward_template = Template()
+        forward_template.set_metadata("performative", "query")
+        self.add_behaviour(self.ForwardBehaviour(), forward_template)
+
+        inform_template = Template()
+        inform_template.set_metadata("performative", "inform")
+        refuse_template = Template()
+        refuse_template.set_metadata("performative", "refuse")
+        failure_template = Template()
+        failure_template.set_metadata("performative", "failure")
+        self.add_behaviour(self.RelayBehaviour(), inform_template | refuse_template | failure_template)
+
+        cancel_template = Template()
+        cancel_template.set_metadata("performative", "cancel")
+        self.add_behaviour(self.CancelBehaviour(), cancel_template)
+
+        self.add_behaviour(self.WatchdogBehaviour(period=max(1, self.drain_timeout / 4)))
 
 
 ### TESTING
@@ -104,7 +809,7 @@ class MessageTester(Agent):
             await self.send(test)
 
             response = await self.receive()
-            logging.info(f"MessageTester: response: {response}")
+            logger.info("MessageTester: response: %s", response)
 
             await self.agent.stop()
     
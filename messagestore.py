@@ -0,0 +1,104 @@
+import weakref
+import json
+
+### CHATENTRY
+# one chat message, shared by every player holding it instead of each keeping
+# its own dict. slots keep it to two references (and a weakref slot for the
+# store), and it's never changed once made. reads like the dict it stands in
+# for: entry["content"] and entry.get("role") both work
+class ChatEntry:
+    __slots__ = ("role", "content", "__weakref__")
+
+    def __init__(self, role, content):
+        object.__setattr__(self, "role", role)
+        object.__setattr__(self, "content", content)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ChatEntry is immutable")
+
+    def __getitem__(self, key):
+        if key in ChatEntry.__slots__[:2]:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in ChatEntry.__slots__[:2]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def as_dict(self):
+        return {"role": self.role, "content": self.content}
+
+    def __eq__(self, other):
+        if isinstance(other, ChatEntry):
+            return self.role == other.role and self.content == other.content
+        return other == self.as_dict()
+
+    def __hash__(self):
+        return hash((self.role, self.content))
+
+    def __repr__(self):
+        return f"ChatEntry({self.role!r}, {self.content!r})"
+
+# for json.dumps(..., default=as_json), so contexts holding entries still
+# serialize the way a list of dicts would
+def as_json(entry):
+    if isinstance(entry, ChatEntry):
+        return entry.as_dict()
+    raise TypeError(f"{type(entry).__name__} is not JSON serializable")
+
+def dumps(messages):
+    return json.dumps(messages, default=as_json)
+
+### MESSAGESTORE
+# interns chat entries by their encoded form (see chatlog.encode_entry), so a
+# room push that reaches every player in this process is decoded once, and
+# every player ends up holding the same ChatEntry. the store itself only keeps
+# weak references: an entry lives for as long as some player's memory (or
+# summary backlog) refers to it, and goes away with the last one, so nothing
+# here grows with the chat history.
+# entries with anything more than a role and content aren't shared, they come
+# back as plain dicts
+#
+# ATTRIBUTES
+# entries       - encoded line -> ChatEntry, weakly held
+# hits, misses  - lookups that found a shared entry, and ones that decoded
+class MessageStore:
+    def __init__(self):
+        self.entries = weakref.WeakValueDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    def intern(self, line):
+        entry = self.entries.get(line)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        data = json.loads(line)
+        if set(data) != {"role", "content"}:
+            return data
+        entry = ChatEntry(data["role"], data["content"])
+        self.entries[line] = entry
+        return entry
+
+    # reads a body made by chatlog.encode_entries, which puts one entry on
+    # each line, without decoding any entry that's already shared
+    def decode(self, body):
+        for line in body.split("\n"):
+            line = line.strip().lstrip("[").rstrip("]").rstrip(",")
+            if line:
+                yield self.intern(line)
+
+    def stats(self):
+        return {"shared": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+    def __len__(self):
+        return len(self.entries)
+
+STORE = MessageStore()
@@ -0,0 +1,186 @@
+import logging
+import asyncio
+import json
+import time
+
+### SETTINGS
+METRICS_HOST = "localhost"
+METRICS_PORT = 9108
+LATENCY_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# labels are kept as sorted tuples so they can be dictionary keys
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def label_text(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+### COUNTER
+# only goes up
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        return [f"{self.name}{label_text(key)} {value}" for key, value in self.values.items()]
+
+    def snapshot(self):
+        return [{"labels": dict(key), "value": value} for key, value in self.values.items()]
+
+### GAUGE
+# goes wherever it's set
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[label_key(labels)] = value
+
+### HISTOGRAM
+# counts observations into cumulative buckets, plus their sum and count
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.values = {} # key -> [bucket counts..., count, sum]
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    # times a block: with histogram.time(agent=...):
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def render(self):
+        lines = []
+        for key, series in self.values.items():
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{label_text(key, [('le', bound)])} {count}")
+            lines.append(f"{self.name}_bucket{label_text(key, [('le', '+Inf')])} {series[-2]}")
+            lines.append(f"{self.name}_count{label_text(key)} {series[-2]}")
+            lines.append(f"{self.name}_sum{label_text(key)} {series[-1]}")
+        return lines
+
+    def snapshot(self):
+        return [{
+            "labels": dict(key),
+            "buckets": dict(zip(map(str, self.buckets), series)),
+            "count": series[-2],
+            "sum": series[-1]
+        } for key, series in self.values.items()]
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.monotonic() - self.started, **self.labels)
+
+### REGISTRY
+# every metric in the process, rendered in the prometheus text format on a 
+# small local HTTP endpoint, and dumped to JSON at shutdown
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.server = None
+
+    def get(self, cls, name, help, *args):
+        if name not in self.metrics:
+            self.metrics[name] = cls(name, help, *args)
+        return self.metrics[name]
+
+    def counter(self, name, help):
+        return self.get(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self.get(Gauge, name, help)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.get(Histogram, name, help, buckets)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {
+            "timestamp": time.time(),
+            "metrics": {name: {"type": metric.kind, "series": metric.snapshot()}
+                        for name, metric in self.metrics.items()}
+        }
+
+    def dump(self, path):
+        try:
+            with open(path, "w") as f:
+                json.dump(self.snapshot(), f, indent=2)
+            logging.info(f"metrics: snapshot written to {path}")
+        except OSError as e:
+            logging.error(f"metrics: writing snapshot: {e}")
+
+    # answers any GET with the current metrics
+    async def handle(self, reader, writer):
+        try:
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            body = self.render().encode()
+            writer.write(b"HTTP/1.1 200 OK\r\n"
+                         b"Content-Type: text/plain; version=0.0.4\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                         b"Connection: close\r\n\r\n" + body)
+            await writer.drain()
+        except Exception as e:
+            logging.debug(f"metrics: serving: {e}")
+        finally:
+            writer.close()
+
+    async def serve(self, host=METRICS_HOST, port=METRICS_PORT):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        logging.info(f"metrics: serving on http://{host}:{port}/metrics")
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+REGISTRY = Registry()
+
+### TESTING
+if __name__ == "__main__":
+    latency = REGISTRY.histogram("test_seconds", "how long the test took")
+    latency.observe(0.3, agent="test")
+    with latency.time(agent="test"):
+        time.sleep(0.01)
+    REGISTRY.counter("test_total", "tests run").inc(agent="test")
+    print(REGISTRY.render())
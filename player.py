@@ -1,13 +1,23 @@
 import spade
 from spade.agent import Agent
-from llminterface import LLMInterfaceAgent
-from spade.behaviour import FSMBehaviour, State
+from llminterface import LLMInterfaceAgent, PRIORITY_NAME, PRIORITY_REPLY, PRIORITY_IDLE, PRIORITY_SUMMARY
+from spade.behaviour import FSMBehaviour, CyclicBehaviour, State
 from spade.message import Message
+from spade.template import Template
 from chatroom import ChatRoomAgent
+from messagestore import STORE, dumps
+from recall import make_index, strip_speaker, QUERY_MESSAGES
+from context import ContextWindow, budget_for
+from metrics import REGISTRY
+from eventlog import get_logger
+from collections import deque
 import json
 from asyncio import sleep
+import uuid
+import asyncio
 import logging
 import random
+import time
 
 ### FSM STATES
 GET_NAME_STATE = "GET_NAME"
@@ -33,162 +43,663 @@ FILLER_PROMPT = "It's pretty quiet over here..."
 ### TIMERS
 CHAT_TIMEOUT = 30
 PROMPT_TIMEOUT = 300
+IDLE_TIMEOUT = 60       # with a scheduler, how long to wait for new chat
+TURN_TIMEOUT = 60       # with a scheduler, how long to wait for a turn
+POLL_INTERVAL = 5       # with a scheduler but no push, the gap between polls
+MAX_BACKOFF = 60        # the longest a busy interface can make the player wait
+FAILURE_BACKOFF = 5     # the wait after the interface failed to answer at all
+
+### METRICS
+STATE_SECONDS = REGISTRY.histogram("wolf_player_state_seconds", "time spent per run of each player FSM state")
+CHAT_RECEIVED = REGISTRY.counter("wolf_player_chat_received_total", "chat entries taken in by players")
+
+### TIMEDSTATE
+# an FSM state that records how long each run of it takes
+class TimedState(State):
+    async def on_start(self):
+        self.started = time.monotonic()
+
+    async def on_end(self):
+        STATE_SECONDS.observe(time.monotonic() - self.started, 
+                              agent=self.agent.name, state=type(self).__name__)
 
 ### PLAYERAGENT
 # houses the framework for any player of the game (human or LLM)
 #
 # ARGUMENTS
 # player_interface:     - stores the JID of the player's "brain"
-# max_memory:           - the maximum number of chat logs held within the context
+# model:                - the model behind player_interface, for sizing memory
+# memory_budget:        - estimated tokens of chat held within the context, 
+#                         defaults to what suits the model
+# stable_prefix:        - keep every prompt an append-only extension of the 
+#                         last until a planned reset, so the model server can
+#                         reuse its prompt cache (see ContextWindow)
 # wait_period:          - the median delay offered to not overwhelm the computer
 # wait_variance:        - randomness, to avoid players clashing over resources
+# push_chat:            - subscribe to the room and have new messages pushed,
+#                         instead of polling it every cycle
+# scheduler:            - JID of a SchedulerAgent handing out speaking turns. 
+#                         with one, the player wakes up when there's something
+#                         new and speaks when given a turn, instead of sleeping
+#                         randomly after every state
+# router:               - JID of a RoomRouterAgent that picks the player's room,
+#                         and may move it around later
+# speculate:            - start drafting the next reply as soon as new chat
+#                         comes in, so the model works through the pacing 
+#                         delay instead of after it
+# stream:               - bots pass their replies to the room as they're 
+#                         generated, and the human player passes everyone 
+#                         else's on to its interface
+# recall_k:             - past chat lines, from long before the memory window,
+#                         added to each prompt when they look relevant. 0 for 
+#                         none (needs numpy)
 #
 # ATTRIBUTES
 # player_name:          - an identifier chosen by the player at the beginning of
 #                         the game: *not* the JID
 # chat_index:           - used to avoid pulling the same logs from the chat twice
 # chatroom              - JID of the active chat
-#
-# TODO: dynamically change the chat address from a static to a dynamic one, in 
-#       order to facilitate phase changes
+# room_indexes          - how far the player had read in rooms it's left
+# chat_buffer           - pushed messages waiting for the next GetChatState
+# chat_arrived          - set whenever something lands in the buffer
+# has_turn              - whether the scheduler's turn is currently held
+# memory                - the ContextWindow of recent chat, with a rolling 
+#                         summary of everything older (bots only)
+#                         chat from the room is held as ChatEntry objects 
+#                         shared with the other players (see messagestore.py)
+# fresh_chat            - whether the last GetChatState brought anything new
+# backoff               - seconds to wait before asking the interface again,
+#                         because it was busy or failed
+# draft_thread          - thread of the draft being generated, None if none
+# draft                 - the draft's reply, once it's come back
+# draft_ready           - set when the draft's reply (or refusal) comes back
+# draft_index           - chat_index when the draft was asked for
+# summary_due           - set when SummaryBehaviour should update the summary
+# stream_thread         - thread of the reply being streamed, None if none
+# streamed              - the pieces of it that have come in so far
+# recall                - RecallIndex of every chat line seen, None if off
 class PlayerAgent(Agent):
-    def __init__(self, jid, password, player_interface, max_memory = 10, 
-                 wait_period = 10, wait_variance = 5, **kwargs):
+    def __init__(self, jid, password, player_interface, model = 'llama3.1', memory_budget = None,
+                 wait_period = 10, wait_variance = 5, push_chat = True, 
+                 scheduler = None, stable_prefix = False, router = None, speculate = False, stream = False, recall_k = 0, **kwargs):
         super().__init__(jid, password, **kwargs)
+        self.logger = get_logger("player", self.name)
 
         self.player_interface = player_interface
         self.player_name = ""
         self.wait_period = wait_period
         self.wait_variance = wait_variance
-        self.memory = []
-        self.max_memory = max_memory
+        self.memory = ContextWindow(memory_budget or budget_for(model), 
+                                    summarize=self.name != "userplayer", stable=stable_prefix)
+        self.system_context = []
         self.chat_index = 0
         self.chatroom = "village@localhost"
+        self.router = router
+        self.room_indexes = {}
+        self.in_room = False
+        self.resumed = False
+        self.push_chat = push_chat
+        self.chat_buffer = deque()
+        self.chat_arrived = asyncio.Event()
+        self.scheduler = scheduler
+        self.has_turn = False
+        self.fresh_chat = False
+        self.backoff = 0
+        self.speculate = speculate
+        self.draft_thread = None
+        self.draft = None
+        self.draft_ready = asyncio.Event()
+        self.draft_index = 0
+        self.summary_due = asyncio.Event()
+        self.stream = stream
+        self.stream_thread = None
+        self.streamed = []
+        self.recall_k = recall_k
+        self.recall = make_index(self.logger) if recall_k else None
 
         self.personality = RANDOM_PERSONALITIES[random.randint(0,len(RANDOM_PERSONALITIES)-1)]
         self.personality_prompt = f"You have a {self.personality} personality."
 
-    # for formatting
-    def log(self, source, message):
-        return f"{self.name}: {source}: {message}"
     
-    # for dramatic tension
+    # for dramatic tension. a scheduler does the pacing instead, if there is one
     async def random_sleep(self):
+        if self.scheduler:
+            return
         await sleep(random.randint(self.wait_period - self.wait_variance, 
                                    self.wait_period + self.wait_variance) * 2)
 
+    # picks up from a snapshot (see snapshot.py) instead of asking the model 
+    # for a name again. recall starts over from the restored memory, lines 
+    # older than that are only in the summary now. call before start()
+    def restore(self, state):
+        self.player_name = state["player_name"]
+        self.personality = state["personality"]
+        self.personality_prompt = f"You have a {self.personality} personality."
+        self.chatroom = state["chatroom"]
+        self.room_indexes = dict(state["room_indexes"])
+        self.room_indexes[self.chatroom] = state["chat_index"]
+        self.memory.extend(state["memory"])
+        self.memory.summary = state["summary"]
+        self.memory.folded = list(state["folded"])
+        self.memory.folded_tokens = state["folded_tokens"]
+        self.remember(self.memory.folded)
+        self.remember(state["memory"])
+        self.resumed = True
+
+    # switches to a room: leaves the old one (remembering how far it read 
+    # there), announces itself, and picks up the new one's chat from wherever 
+    # it left off, or from index if the router says so. coming back from a 
+    # snapshot, nobody needs telling
+    async def enter_room(self, behaviour, room, index=None):
+        if self.in_room:
+            self.room_indexes[self.chatroom] = self.chat_index
+            if self.push_chat:
+                cancel = Message(to=self.chatroom)
+                cancel.set_metadata("performative", "cancel")
+                await behaviour.send(cancel)
+
+        self.chatroom = room
+        self.chat_index = index if index is not None else self.room_indexes.get(room, 0)
+        self.chat_buffer.clear()
+        await self.drop_draft(behaviour)
+
+        if not self.resumed:
+            message = Message(to=self.chatroom)
+            message.set_metadata("performative", "inform")
+            notification = { "role": "system", "content": f"{self.player_name} has entered the room" }
+            message.body = json.dumps(notification)
+
+            self.logger.info("enter_room: %s", message.body)
+            await behaviour.send(message)
+        self.resumed = False
+
+        if self.push_chat:
+            subscribe = Message(to=self.chatroom)
+            subscribe.set_metadata("performative", "subscribe")
+            if self.stream and self.name == "userplayer":
+                subscribe.set_metadata("stream", "1")
+            subscribe.body = str(self.chat_index)
+            await behaviour.send(subscribe)
+        self.in_room = True
+
+    # the system messages every prompt starts with, built once per name
+    def system_prompt(self):
+        if self.name == "userplayer":
+            return []
+        if not self.system_context or self.system_context[0]["content"] != f"Your name is {self.player_name}":
+            self.system_context = [
+                { "role": "system", "content": f"Your name is {self.player_name}" },
+                { "role": "system", "content": CHAT_GEN_PROMPT},
+                { "role": "system", "content": self.personality_prompt}
+            ]
+        return self.system_context
+
+    # sends a prompt to the interface, marked with how urgent it is and when 
+    # the player stops waiting for it. a busy interface's refusal comes back 
+    # as None, with backoff set to how long it asked for. with stream, the 
+    # reply is passed to the room while it's generated (see StreamBehaviour),
+    # and given up on properly if it never finishes
+    async def query_interface(self, behaviour, context, priority, stream=False):
+        self.backoff = 0
+        thread = None
+        if stream:
+            thread = uuid.uuid4().hex
+            self.stream_thread = thread
+            self.streamed = []
+
+        request = Message(to=self.player_interface, thread=thread)
+        request.set_metadata("performative", "query")
+        request.set_metadata("priority", str(priority))
+        if stream:
+            request.set_metadata("stream", "1")
+        request.set_metadata("deadline", str(time.time() + PROMPT_TIMEOUT))
+        request.body = dumps(context)
+
+        self.logger.debug("query_interface: %s", request.body)
+        await behaviour.send(request)
+
+        response = await self.receive_from(behaviour, self.player_interface, PROMPT_TIMEOUT)
+        self.stream_thread = None
+        if response and response.get_metadata("performative") == "refuse":
+            self.backoff = min(float(json.loads(response.body).get("retry_after", 1)), MAX_BACKOFF)
+            self.logger.warning("query_interface: %s is busy, backing off %ss", 
+                                self.player_interface, self.backoff)
+            return None
+        if response and response.get_metadata("performative") == "failure":
+            self.backoff = FAILURE_BACKOFF
+            self.logger.warning("query_interface: %s couldn't answer (%s), backing off %ss", 
+                                self.player_interface, response.body, self.backoff)
+            response = None
+        if stream and response is None:
+            await self.abandon_stream(behaviour, thread)
+        return response
+
+    # stops the interface generating a reply nobody's waiting for any more, 
+    # and takes back whatever of it the room has already seen
+    async def abandon_stream(self, behaviour, thread):
+        cancel = Message(to=self.player_interface, thread=thread)
+        cancel.set_metadata("performative", "cancel")
+        await behaviour.send(cancel)
+
+        if self.streamed:
+            abort = Message(to=self.chatroom, thread=thread)
+            abort.set_metadata("performative", "inform")
+            abort.set_metadata("channel", "stream")
+            abort.set_metadata("stage", "abort")
+            abort.body = json.dumps({"role": "user", "content": ""})
+            await behaviour.send(abort)
+        self.streamed = []
+        self.logger.info("abandon_stream: gave up on %s", thread)
+
+    # waits out whatever the last refusal asked for
+    async def back_off(self):
+        if self.backoff:
+            await sleep(self.backoff)
+            self.backoff = 0
+
+    # what the interface is prompted with for the next chat message. recalled
+    # lines go last, so everything before them stays the same from one prompt
+    # to the next (see stable_prefix)
+    def prompt_context(self):
+        return [*self.system_prompt(), *self.memory.prefix(), *self.memory, *self.recalled()]
+
+    # indexes chat lines from other players (and its own, as the room 
+    # echoes them) for recall later
+    def remember(self, messages):
+        if self.recall is None:
+            return
+        for message in messages:
+            if message.get("role") == "user":
+                self.recall.add(str(message.get("content", "")))
+
+    # the past lines most like the newest chat, that aren't in memory already
+    def recalled(self):
+        if self.recall is None or not len(self.memory):
+            return []
+        recent = list(self.memory)[-QUERY_MESSAGES:]
+        query = " ".join(strip_speaker(str(message.get("content", ""))) for message in recent)
+        in_memory = {str(message.get("content", "")) for message in self.memory}
+        lines = self.recall.search(query, self.recall_k, exclude=in_memory)
+        if not lines:
+            return []
+        self.logger.debug("recalled: %s", lines)
+        return [{ "role": "system", "content": "Said earlier, and maybe relevant now:\n" + "\n".join(lines) }]
+
+    # with speculate: asks for the next reply now, on the draft channel, while
+    # the player waits for its turn. not worth it when memory is about to be 
+    # summarized, since the context would change under it anyway
+    async def start_draft(self, behaviour):
+        await self.drop_draft(behaviour)
+        if self.memory.needs_summary():
+            return
+        self.draft_thread = uuid.uuid4().hex
+        self.draft_index = self.chat_index
+        request = Message(to=self.player_interface, thread=self.draft_thread)
+        request.set_metadata("performative", "query")
+        request.set_metadata("channel", "draft")
+        request.set_metadata("priority", str(PRIORITY_IDLE))
+        request.set_metadata("deadline", str(time.time() + PROMPT_TIMEOUT))
+        request.body = dumps(self.prompt_context())
+        await behaviour.send(request)
+        self.logger.debug("start_draft: %s", self.draft_thread)
+
+    # forgets the draft. one that's still being generated is cancelled, so it
+    # stops holding a slot (and a place in the queue) on the interface. if its
+    # reply turns up anyway, DraftBehaviour ignores it
+    async def drop_draft(self, behaviour):
+        if self.draft_thread and not self.draft_ready.is_set():
+            cancel = Message(to=self.player_interface, thread=self.draft_thread)
+            cancel.set_metadata("performative", "cancel")
+            await behaviour.send(cancel)
+        self.draft_thread = None
+        self.draft = None
+        self.draft_ready.clear()
+
+    # the draft, if it still fits. any chat that came in since it was asked 
+    # for means it answers the wrong thing, so it's thrown away. without 
+    # push_chat the room is polled first to find out, and whatever's new goes
+    # into memory as GetChatState would have put it. waits for the draft if 
+    # it's still being generated
+    async def take_draft(self, behaviour):
+        if not self.draft_thread:
+            return None
+        if not self.push_chat:
+            new_messages = await self.poll_chat(behaviour)
+            if new_messages:
+                self.memory.extend(new_messages)
+                self.remember(new_messages)
+        if self.chat_index != self.draft_index:
+            self.logger.debug("take_draft: chat moved on, dropping draft")
+            await self.drop_draft(behaviour)
+            return None
+
+        try:
+            await asyncio.wait_for(self.draft_ready.wait(), PROMPT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.logger.warning("take_draft: draft from %s timed out", self.player_interface)
+        draft = self.draft
+        await self.drop_draft(behaviour)
+        return draft
+
+    # folds the chat that's fallen out of memory into the rolling summary. 
+    # runs in SummaryBehaviour, on the summary channel, so the player isn't
+    # holding a turn while it waits behind every other prompt
+    async def summarize_memory(self, behaviour):
+        count = len(self.memory.folded)
+        thread = uuid.uuid4().hex
+        request = Message(to=self.player_interface, thread=thread)
+        request.set_metadata("performative", "query")
+        request.set_metadata("channel", "summary")
+        request.set_metadata("priority", str(PRIORITY_SUMMARY))
+        request.set_metadata("deadline", str(time.time() + PROMPT_TIMEOUT))
+        request.body = dumps(self.memory.summary_request())
+        await behaviour.send(request)
+
+        response = await self.receive_from(behaviour, self.player_interface, PROMPT_TIMEOUT, thread)
+        if response and response.get_metadata("performative") == "inform":
+            summary = json.loads(response.body).get("content", "")
+            if summary:
+                self.memory.apply_summary(summary, count)
+                self.logger.info("summarize_memory: summary now %s", self.memory.summary)
+                return
+        self.logger.warning("summarize_memory: no summary, will try again later")
+
+    # once the turn's been given back, hands old chat to SummaryBehaviour
+    def schedule_summary(self):
+        if self.memory.needs_summary():
+            self.summary_due.set()
+
+    # skips anything that isn't from the expected sender (and on the expected
+    # thread, if there is one), like a stale reply from an earlier timeout
+    async def receive_from(self, behaviour, sender, timeout, thread=None):
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            message = await behaviour.receive(timeout=remaining)
+            if message is None:
+                return None
+            if str(message.sender.bare()) == sender and thread in (None, message.thread):
+                return message
+            self.logger.debug("receive_from: skipped message from %s (thread %s)", message.sender, message.thread)
+        return None
+
+    # asks the room for everything past chat_index, None if it doesn't answer
+    async def poll_chat(self, behaviour):
+        request = Message(to=self.chatroom)
+        request.set_metadata("performative", "query")
+        request.body = str(self.chat_index)
+
+        self.logger.debug("poll_chat: chat index = %s", request.body)
+        await behaviour.send(request)
+
+        response = await self.receive_from(behaviour, self.chatroom, CHAT_TIMEOUT)
+        if not response:
+            return None
+
+        self.catch_up(response)
+        new_messages = list(STORE.decode(response.body))
+        self.chat_index += len(new_messages)
+        return new_messages
+
+    # a room with nowhere to keep its chat forgets the oldest of it. when 
+    # what it sends starts past chat_index, the lines in between are gone,
+    # and the index skips over them instead of falling behind for good
+    def catch_up(self, message):
+        index = message.get_metadata("index")
+        if index is not None and int(index) > self.chat_index:
+            self.logger.warning("catch_up: %s no longer has lines %s to %s", 
+                                self.chatroom, self.chat_index, int(index) - 1)
+            self.chat_index = int(index)
+
+    # with a scheduler: sleeps until the room has something new, or until the 
+    # player's been idle long enough to say something anyway
+    async def wait_for_chat(self):
+        if not self.push_chat:
+            await sleep(POLL_INTERVAL)
+            return
+        try:
+            await asyncio.wait_for(self.chat_arrived.wait(), IDLE_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
+    # with a scheduler: queues for a turn and waits for it
+    async def request_turn(self, behaviour, fresh):
+        thread = uuid.uuid4().hex
+        request = Message(to=self.scheduler, thread=thread)
+        request.set_metadata("performative", "request")
+        request.body = json.dumps({"fresh": fresh})
+        await behaviour.send(request)
+
+        grant = await self.receive_from(behaviour, self.scheduler, TURN_TIMEOUT, thread)
+        if grant and grant.get_metadata("performative") == "agree":
+            self.has_turn = True
+            return True
+
+        cancel = Message(to=self.scheduler)
+        cancel.set_metadata("performative", "cancel")
+        await behaviour.send(cancel)
+        return False
+
+    # with a scheduler: hands the turn back
+    async def release_turn(self, behaviour):
+        if not self.has_turn:
+            return
+        self.has_turn = False
+        release = Message(to=self.scheduler)
+        release.set_metadata("performative", "confirm")
+        await behaviour.send(release)
+
     ### GETNAMESTATE
     # the initial state, queries the player interface for an identifier
-    class GetNameState(State):
+    # a busy interface gets asked again once it's had time to catch up
+    class GetNameState(TimedState):
         async def run(self):
-            #sending
             try:
-                request = Message(to=self.agent.player_interface)
-                request.set_metadata("performative", "query")
-
                 prompt = [{ "role": "user", "content": NAME_GEN_PROMPT + " " + self.agent.personality_prompt }] # NOTE: list!!
-                request.body = json.dumps(prompt)
-
-                logging.debug(self.agent.log("GetNameState, sending", request.body))
-                await self.send(request)
+                response = await self.agent.query_interface(self, prompt, PRIORITY_NAME)
 
-            except Exception as e:
-                logging.error(self.agent.log("GetNameState, sending", e))
-                self.kill() # beyond hope
-
-            # receiving
-            try:
-                response = await self.receive(timeout=PROMPT_TIMEOUT)
-                if response:
-                    logging.info(self.agent.log(f"GetNameState received name of type: {type(response.body)}", response.body))
+                if self.agent.backoff:
+                    await self.agent.back_off()
+                    self.set_next_state(GET_NAME_STATE)
+                elif response:
+                    self.agent.logger.info("GetNameState received name of type: %s: %s", type(response.body), response.body)
                     data = json.loads(response.body)
 
-                    logging.debug(self.agent.log("GetNameState JSON loads", data))
+                    self.agent.logger.debug("GetNameState JSON loads: %s", data)
                     self.agent.player_name = data["content"]
                     
                     await self.agent.random_sleep()
                     self.set_next_state(JOIN_ROOM_STATE)
 
             except Exception as e:
-                logging.error(self.agent.log("GetNameState, receiving", e))
+                self.agent.logger.error("GetNameState: %s", e)
                 self.kill() # pitiful
     
     ### JOINROOMSTATE
-    # sends a notice message to a ChatRoomAgent to inform other players
+    # asks the router which room to join (if there is one), and sends a notice 
+    # message to that ChatRoomAgent to inform other players
     # TODO: commented out the announcement, because it makes the AI WEIRD
-    class JoinRoomState(State):
+    class JoinRoomState(TimedState):
         async def run(self):
             try:
-                message = Message(to=self.agent.chatroom)
-                message.set_metadata("performative", "inform")
-                notification = { "role": "system", "content": f"{self.agent.player_name} has entered the room" }
-                message.body = json.dumps(notification)
+                room = self.agent.chatroom
+                if self.agent.router:
+                    request = Message(to=self.agent.router)
+                    request.set_metadata("performative", "request")
+                    await self.send(request)
 
-                logging.info(self.agent.log("JoinRoomState", message.body))
-                await self.send(message)
+                    response = await self.agent.receive_from(self, self.agent.router, CHAT_TIMEOUT)
+                    if response:
+                        room = json.loads(response.body)["room"]
+                    else:
+                        self.agent.logger.warning("JoinRoomState: no answer from %s, staying in %s", 
+                                                  self.agent.router, room)
+
+                await self.agent.enter_room(self, room)
                 self.set_next_state(GET_CHAT_STATE)
 
             except Exception as e:
-                logging.error(self.agent.log("JoinRoomState, receiving", e))
+                self.agent.logger.error("JoinRoomState, receiving: %s", e)
                 self.kill() # can't even say hi
 
-            self.agent.chat_index = 0 # reset the value
+    ### MOVEBEHAVIOUR
+    # runs alongside the FSM when there's a router, following its orders to 
+    # change rooms
+    class MoveBehaviour(CyclicBehaviour):
+        async def run(self):
+            try:
+                order = await self.receive(timeout=CHAT_TIMEOUT)
+                if order and str(order.sender.bare()) == self.agent.router:
+                    move = json.loads(order.body)
+                    self.agent.logger.info("MoveBehaviour: moving to %s", move["room"])
+                    await self.agent.enter_room(self, move["room"], move.get("index"))
+            except Exception as e:
+                self.agent.logger.error("MoveBehaviour: %s", e)
+
+    ### DRAFTBEHAVIOUR
+    # runs alongside the FSM when speculate is on, picking up the replies to
+    # drafts. anything for a draft that's since been dropped is ignored
+    class DraftBehaviour(CyclicBehaviour):
+        async def run(self):
+            try:
+                reply = await self.receive(timeout=CHAT_TIMEOUT)
+                if not reply or reply.thread != self.agent.draft_thread:
+                    return
+                if reply.get_metadata("performative") == "inform":
+                    message = json.loads(reply.body)
+                    if message.get("content"):
+                        self.agent.draft = message
+                self.agent.draft_ready.set()
+            except Exception as e:
+                self.agent.logger.error("DraftBehaviour: %s", e)
+
+    ### SUMMARYBEHAVIOUR
+    # runs alongside the FSM for bots, updating the summary between turns 
+    # whenever schedule_summary says it's due
+    class SummaryBehaviour(CyclicBehaviour):
+        async def run(self):
+            try:
+                await asyncio.wait_for(self.agent.summary_due.wait(), CHAT_TIMEOUT)
+            except asyncio.TimeoutError:
+                return
+            self.agent.summary_due.clear()
+            try:
+                if self.agent.memory.needs_summary():
+                    await self.agent.summarize_memory(self)
+            except Exception as e:
+                self.agent.logger.error("SummaryBehaviour: %s", e)
+
+    ### STREAMBEHAVIOUR
+    # runs alongside the FSM when stream is on. chunks of the reply being 
+    # generated go on to the room as the text so far, and partial replies from
+    # the room (for the human player) go on to the interface
+    class StreamBehaviour(CyclicBehaviour):
+        async def run(self):
+            try:
+                chunk = await self.receive(timeout=CHAT_TIMEOUT)
+                if not chunk:
+                    return
+                sender = str(chunk.sender.bare())
+
+                if sender == self.agent.player_interface:
+                    if chunk.thread != self.agent.stream_thread:
+                        return
+                    self.agent.streamed.append(json.loads(chunk.body)["delta"])
+                    partial = Message(to=self.agent.chatroom, thread=chunk.thread)
+                    partial.set_metadata("performative", "inform")
+                    partial.set_metadata("channel", "stream")
+                    partial.set_metadata("stage", "partial")
+                    partial.body = json.dumps({
+                        "role": "user", "content": f"{self.agent.player_name}: {''.join(self.agent.streamed)}"
+                    })
+                    await self.send(partial)
+
+                elif sender == self.agent.chatroom:
+                    partial = Message(to=self.agent.player_interface, thread=chunk.thread)
+                    partial.set_metadata("performative", "inform")
+                    partial.set_metadata("channel", "stream")
+                    partial.set_metadata("stage", chunk.get_metadata("stage") or "partial")
+                    partial.body = chunk.body
+                    await self.send(partial)
+            except Exception as e:
+                self.agent.logger.error("StreamBehaviour: %s", e)
+
+    ### CHATFEEDBEHAVIOUR
+    # runs alongside the FSM when push_chat is on, collecting whatever the room 
+    # pushes into the local buffer. stragglers from a room it's just left are 
+    # ignored
+    class ChatFeedBehaviour(CyclicBehaviour):
+        async def run(self):
+            try:
+                push = await self.receive(timeout=CHAT_TIMEOUT)
+                if push and str(push.sender.bare()) == self.agent.chatroom:
+                    self.agent.catch_up(push)
+                    for entry in STORE.decode(push.body):
+                        self.agent.chat_buffer.append(entry)
+                        self.agent.chat_index += 1
+                    self.agent.chat_arrived.set()
+            except Exception as e:
+                self.agent.logger.error("ChatFeedBehaviour: %s", e)
 
     ### GETCHATSTATE
     # retreieves the newest message from the active chat room and processes them
-    class GetChatState(State):
+    # with push_chat they're already sitting in the buffer, otherwise the room 
+    # gets polled for everything past chat_index (see poll_chat)
+    class GetChatState(TimedState):
+        def drain(self):
+            new_messages = list(self.agent.chat_buffer)
+            self.agent.chat_buffer.clear()
+            self.agent.chat_arrived.clear()
+            return new_messages
+
         async def run(self):
             # retrieve
             try:
-                request = Message(to=self.agent.chatroom)
-                request.set_metadata("performative", "query")
-                request.body = str(self.agent.chat_index)
+                if self.agent.scheduler:
+                    await self.agent.wait_for_chat()
 
-                logging.info(self.agent.log("GetChatState", f"chat index = {request.body}"))
-                await self.send(request)
+                if self.agent.push_chat:
+                    new_messages = self.drain()
+                else:
+                    new_messages = await self.agent.poll_chat(self)
 
                 # process
-                try:
-                    response = await self.receive(timeout=CHAT_TIMEOUT)
-
-                    if response:
-
-                        new_messages = json.loads(response.body)
-                        self.agent.chat_index += len(new_messages)
-                        logging.debug(self.agent.log("GetChatState", 
-                            f"received data from {self.agent.chatroom}: {new_messages}: {type(new_messages)}"))
-
-                        # add new context
-                        if new_messages == []:
-                            quiet = {
-                                "role": "user", "content": "It's pretty quiet over here..."
-                            }
-                            self.agent.memory.append(quiet)
-                            logging.info(self.agent.log("GetChatState", f"added quiet line = {self.agent.memory}"))
+                if new_messages is not None:
+                    self.agent.logger.debug("GetChatState: received data from %s: %s: %s", self.agent.chatroom, new_messages, type(new_messages))
+
+                    # add new context
+                    if new_messages == []:
+                        quiet = {
+                            "role": "user", "content": FILLER_PROMPT
+                        }
+                        self.agent.memory.append(quiet)
+                        self.agent.logger.debug("GetChatState: added quiet line")
+                    else:
+                        self.agent.memory.extend(new_messages)
+                        self.agent.remember(new_messages)
+                        CHAT_RECEIVED.inc(len(new_messages), agent=self.agent.name)
+
+                    self.agent.logger.debug("GetChatState: current memory %s", self.agent.memory)
+                    self.agent.fresh_chat = new_messages != []
+                    if self.agent.speculate:
+                        if self.agent.fresh_chat:
+                            await self.agent.start_draft(self)
                         else:
-                            self.agent.memory = self.agent.memory + new_messages
+                            await self.agent.drop_draft(self)
                     
-
-                        if len(self.agent.memory) > self.agent.max_memory:
-                            self.agent.memory = self.agent.memory[-self.agent.max_memory:]
-                            logging.info(self.agent.log("GetChatState", 
-                                f"memory exeeds {self.agent.max_memory} chats, pruned: {self.agent.memory}"))
-                        else:
-                            logging.info(self.agent.log("GetChatState", f"current memory {self.agent.memory}"))
-                        
-                        await self.agent.random_sleep()
-                        self.set_next_state(PROMPT_STATE) # continue
+                    if self.agent.scheduler and not await self.agent.request_turn(self, new_messages != []):
+                        self.agent.logger.info("GetChatState: no turn given")
+                        self.set_next_state(GET_CHAT_STATE)
                         return
 
-                    else:
-                        logging.warning(self.agent.log("GetChatState", 
-                            f"response from {self.agent.chatroom} timed out"))
+                    await self.agent.random_sleep()
+                    self.set_next_state(PROMPT_STATE) # continue
+                    return
 
-                except Exception as e:
-                    logging.error(self.agent.log("GetChatState, processing", e))
+                else:
+                    self.agent.logger.warning("GetChatState: response from %s timed out", self.agent.chatroom)
 
             except Exception as e:
-                logging.error(self.agent.log("GetChatState, retrieving", e))
+                self.agent.logger.error("GetChatState, retrieving: %s", e)
 
             await self.agent.random_sleep()
             self.set_next_state(GET_CHAT_STATE) # retry
@@ -196,61 +707,58 @@ class PlayerAgent(Agent):
 
     ### PROMPTSTATE
     # prompts the LLM or user interface
-    class PromptState(State):
+    class PromptState(TimedState):
         async def run(self):
             # thinking
             try:
-                request = Message(to=self.agent.player_interface)
-                request.set_metadata("performative", "query")
-
-
-                if self.agent.name != "userplayer":
-                    context = [
-                        { "role": "system", "content": f"Your name is {self.agent.player_name}" },
-                        { "role": "system", "content": CHAT_GEN_PROMPT},
-                        { "role": "system", "content": self.agent.personality_prompt}
-                    ]
-                else:
-                    context = []
-
-                context = context + self.agent.memory
-                request.body = json.dumps(context)
+                draft = await self.agent.take_draft(self)
+                if draft:
+                    self.agent.logger.debug("PromptState: using draft %s", draft)
+                    self.agent.memory.append(draft)
+                    self.set_next_state(SEND_STATE)
+                    return
 
-                logging.info(self.agent.log("PromptState", request.body))
-                await self.send(request)
+                context = self.agent.prompt_context()
+                priority = PRIORITY_REPLY if self.agent.fresh_chat else PRIORITY_IDLE
+                stream = self.agent.stream and self.agent.name != "userplayer"
 
                 # receiving
                 try:
-                    response = await self.receive(timeout=PROMPT_TIMEOUT)
+                    response = await self.agent.query_interface(self, context, priority, stream)
                     if response:
                         message = json.loads(response.body)
-                        logging.debug(self.agent.log("PromptState", 
-                                f"received data from {self.agent.player_interface}: {message}: {type(message)}"))
+                        self.agent.logger.debug("PromptState: received data from %s: %s: %s", self.agent.player_interface, message, type(message))
                         
                         if "content" in message and message["content"] != "":
                             self.agent.memory.append(message)
                             self.set_next_state(SEND_STATE) # continue
                             return
+                        elif self.agent.name == "userplayer":
+                            # the incremental UI answers "" when nothing was typed, to let the 
+                            # game fetch more chat while the human thinks
+                            self.agent.logger.debug("PromptState: nothing typed yet")
                         else:
-                            logging.warning(self.agent.log("PromptState", "Message does not contain 'content' or is empty"))
+                            self.agent.logger.warning("PromptState: Message does not contain 'content' or is empty")
 
-                    else:
-                        logging.warning(self.agent.log("PromptState", 
-                                f"response from {self.agent.player_interface} timed out"))
+                    elif not self.agent.backoff:
+                        self.agent.logger.warning("PromptState: response from %s timed out", self.agent.player_interface)
                         
                 except Exception as e:
-                    logging.error(self.agent.log("PromptState, receiving", e))
+                    self.agent.logger.error("PromptState, receiving: %s", e)
 
             except Exception as e:
-                logging.error(self.agent.log("PromptState, retrieving", e))
+                self.agent.logger.error("PromptState, retrieving: %s", e)
 
+            await self.agent.release_turn(self)
+            self.agent.schedule_summary()
+            await self.agent.back_off()
             await self.agent.random_sleep()
             self.set_next_state(GET_CHAT_STATE) # turn back
 
     
     ### SENDSTATE
     # sends a message to the chat room
-    class SendState(State):
+    class SendState(TimedState):
         async def run(self):
             try:
                 inform = Message(to=self.agent.chatroom)
@@ -258,35 +766,39 @@ class PlayerAgent(Agent):
                 last = self.agent.memory[-1]
 
                 if last["content"] != FILLER_PROMPT:
-                    logging.info(self.agent.log("SendState last", last))
+                    self.agent.logger.debug("SendState last: %s", last)
 
                     message = {
                         "role": "user", "content": f"{self.agent.player_name}: {self.agent.memory[-1]['content']}"
                     }
                     
                     inform.body = json.dumps(message)
-                    logging.info(self.agent.log("SendState inform", inform.body))
+                    self.agent.logger.info("SendState inform: %s", inform.body)
 
                     await self.send(inform)
                     await self.agent.random_sleep()
 
             except Exception as e:
-                logging.error(self.agent.log("SendState, retrieving", e))
+                self.agent.logger.error("SendState, retrieving: %s", e)
             
+            await self.agent.release_turn(self)
+            self.agent.schedule_summary()
             self.set_next_state(GET_CHAT_STATE) 
 
     ### VOTESTATE
     # TODO: stub. sends a vote to the GameMaster    
-    class VoteState(State):
+    class VoteState(TimedState):
         async def run():
             pass
 
     async def setup(self):
         fsm = FSMBehaviour()
-        fsm.add_state(name=GET_NAME_STATE, state=self.GetNameState(), initial=True)
+        # a restored player already has a name
+        fsm.add_state(name=GET_NAME_STATE, state=self.GetNameState(), initial=not self.player_name)
+        fsm.add_transition(source=GET_NAME_STATE, dest=GET_NAME_STATE)
         fsm.add_transition(source=GET_NAME_STATE, dest=JOIN_ROOM_STATE)
 
-        fsm.add_state(name=JOIN_ROOM_STATE, state=self.JoinRoomState())
+        fsm.add_state(name=JOIN_ROOM_STATE, state=self.JoinRoomState(), initial=bool(self.player_name))
         fsm.add_transition(source=JOIN_ROOM_STATE, dest=GET_CHAT_STATE)
 
         fsm.add_state(name=GET_CHAT_STATE, state=self.GetChatState())
@@ -300,7 +812,31 @@ class PlayerAgent(Agent):
         fsm.add_state(name=SEND_STATE, state=self.SendState())
         fsm.add_transition(source=SEND_STATE, dest=GET_CHAT_STATE)
 
-        self.add_behaviour(fsm)
+        # pushed chat goes to the feed, router orders to the mover, and 
+        # everything else to the FSM
+        feed_template = Template()
+        feed_template.set_metadata("channel", "chat")
+        control_template = Template()
+        control_template.set_metadata("channel", "control")
+        draft_template = Template()
+        draft_template.set_metadata("channel", "draft")
+        stream_template = Template()
+        stream_template.set_metadata("channel", "stream")
+        summary_template = Template()
+        summary_template.set_metadata("channel", "summary")
+        self.add_behaviour(fsm, ~feed_template & ~control_template & ~draft_template 
+                           & ~stream_template & ~summary_template)
+
+        if self.push_chat:
+            self.add_behaviour(self.ChatFeedBehaviour(), feed_template)
+        if self.router:
+            self.add_behaviour(self.MoveBehaviour(), control_template)
+        if self.speculate:
+            self.add_behaviour(self.DraftBehaviour(), draft_template)
+        if self.stream:
+            self.add_behaviour(self.StreamBehaviour(), stream_template)
+        if self.memory.summarize:
+            self.add_behaviour(self.SummaryBehaviour(), summary_template)
 
 ### TESTING
 async def main():
@@ -0,0 +1,123 @@
+import zlib
+import re
+
+# numpy is only needed for recall, the game runs fine without it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+### SETTINGS
+DIMENSIONS = 256        # buckets words are hashed into
+INITIAL_CAPACITY = 256  # rows allocated up front, doubled when they run out
+RECALL_K = 3            # past messages added to a prompt
+MIN_SIMILARITY = 0.25   # below this, a past message isn't worth the tokens
+QUERY_MESSAGES = 3      # the newest messages that make up the query
+
+WORD = re.compile(r"[a-z0-9']+")
+SPEAKER = re.compile(r"^[^:\n]{1,40}:\s+")
+STOPWORDS = frozenset("""the and you that this was for are with have not but what all
+were when your can said there use each which she how their will other about out
+many then them these some her would make like him into has look two more write see
+number way could people than first been call who its now find down day did get come
+made may part just know yeah too very really here over""".split())
+
+### EMBED
+# a bag of words through the hashing trick: every word lands in one of
+# dimensions buckets, with a sign from its hash so collisions tend to cancel
+# instead of piling up. no model and no vocabulary, so a message is embedded
+# the moment it comes in, and the same words always land in the same place.
+# returns None for a message with nothing worth matching on
+def embed(text, dimensions=DIMENSIONS):
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for word in WORD.findall(text.lower()):
+        if len(word) < 3 or word in STOPWORDS:
+            continue
+        bucket = zlib.crc32(word.encode())
+        vector[bucket % dimensions] += 1.0 if bucket & 0x80000000 else -1.0
+
+    norm = np.linalg.norm(vector)
+    if not norm:
+        return None
+    return vector / norm
+
+### STRIP_SPEAKER
+# a chat line without the "Name: " it starts with. names turn up in nearly
+# every line, so left in they'd outweigh what was actually said
+def strip_speaker(line):
+    return SPEAKER.sub("", line, count=1)
+
+### RECALLINDEX
+# a player's long-term memory: every chat line it's seen, embedded into one
+# growing NumPy array, so finding the lines most like the current chat is a
+# single matrix-vector product however long the game's been going. lines are
+# added as they come in and never re-embedded. only what was said is embedded,
+# not who said it, but the whole line is what comes back. repeats (like join 
+# notices) are only kept once
+#
+# ARGUMENTS
+# dimensions    - size of the embeddings
+# capacity      - rows allocated up front
+#
+# ATTRIBUTES
+# vectors       - the embeddings, one row per line, count rows in use
+# texts         - the lines themselves, in the order they came in
+class RecallIndex:
+    def __init__(self, dimensions=DIMENSIONS, capacity=INITIAL_CAPACITY):
+        if np is None:
+            raise RuntimeError("recall needs numpy")
+        self.dimensions = dimensions
+        self.vectors = np.zeros((capacity, dimensions), dtype=np.float32)
+        self.texts = []
+        self.seen = set()
+        self.count = 0
+
+    def add(self, text):
+        if text in self.seen:
+            return
+        vector = embed(strip_speaker(text), self.dimensions)
+        if vector is None:
+            return
+
+        if self.count == len(self.vectors):
+            grown = np.zeros((len(self.vectors) * 2, self.dimensions), dtype=np.float32)
+            grown[:self.count] = self.vectors
+            self.vectors = grown
+        self.vectors[self.count] = vector
+        self.texts.append(text)
+        self.seen.add(text)
+        self.count += 1
+
+    # the k lines most like query, oldest first, leaving out anything in
+    # exclude (what's already in the prompt) and anything below min_similarity
+    def search(self, query, k=RECALL_K, exclude=(), min_similarity=MIN_SIMILARITY):
+        vector = embed(query, self.dimensions) if self.count else None
+        if vector is None:
+            return []
+
+        scores = self.vectors[:self.count] @ vector
+        wanted = min(self.count, k + len(exclude))
+        best = np.argpartition(-scores, wanted - 1)[:wanted]
+        best = best[np.argsort(-scores[best])]
+
+        found = []
+        for row in best:
+            if scores[row] < min_similarity or len(found) == k:
+                break
+            if self.texts[row] not in exclude:
+                found.append(row)
+        return [self.texts[row] for row in sorted(found)]
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return f"RecallIndex({self.count} lines, {self.vectors.nbytes // 1024} KB)"
+
+### MAKE_INDEX
+# a RecallIndex, or None (with a warning) when numpy isn't there
+def make_index(logger):
+    if np is None:
+        logger.warning("make_index: numpy isn't installed, recall is off")
+        return None
+    return RecallIndex()
@@ -0,0 +1,133 @@
+from spade.agent import Agent
+from spade.behaviour import CyclicBehaviour, PeriodicBehaviour
+from spade.template import Template
+from spade.message import Message
+from eventlog import get_logger
+import json
+
+### SETTINGS
+LISTEN_TIMEOUT = 10
+REBALANCE_PERIOD = 30
+
+### ROOMROUTERAGENT
+# decides which ChatRoomAgent each player sits in, so a crowd can be split over
+# several independent rooms instead of all leaning on one. players ask where to
+# go when they join, and get moved (with a control message) when the router 
+# rebalances the rooms, or when something asks it to move people, like a phase 
+# change from the village to the hideout.
+# players remember how far they've read in each room, so moving back and forth
+# never replays what they've already seen
+#
+# ARGUMENTS
+# rooms         - JIDs of the rooms to spread players over
+# capacity      - players per room before it's considered full, None to just 
+#                 keep the rooms even
+# rebalance     - periodically move players out of crowded rooms
+#
+# ATTRIBUTES
+# assignments   - player JID -> room JID
+class RoomRouterAgent(Agent):
+    def __init__(self, jid, password, rooms, capacity=None, rebalance=True, **kwargs):
+        super().__init__(jid, password, **kwargs)
+        self.rooms = list(rooms)
+        self.capacity = capacity
+        self.rebalance = rebalance
+        self.assignments = {}
+        self.logger = get_logger("room", self.name)
+
+    def occupancy(self):
+        counts = {room: 0 for room in self.rooms}
+        for room in self.assignments.values():
+            if room in counts:
+                counts[room] += 1
+        return counts
+
+    # the emptiest room, preferring ones under capacity
+    def pick_room(self):
+        counts = self.occupancy()
+        return min(self.rooms, key=lambda room: (
+            self.capacity is not None and counts[room] >= self.capacity, counts[room]))
+
+    # tells a player to change rooms
+    async def move(self, behaviour, player, room, index=None):
+        if self.assignments.get(player) == room:
+            return
+        self.assignments[player] = room
+
+        message = Message(to=player)
+        message.set_metadata("performative", "inform")
+        message.set_metadata("channel", "control")
+        move = {"room": room}
+        if index is not None:
+            move["index"] = index
+        message.body = json.dumps(move)
+        await behaviour.send(message)
+        self.logger.info("move: %s -> %s", player, room)
+
+    ### ROUTEBEHAVIOUR
+    # request: a player asking where to go, answered with an agree
+    # cancel: a player leaving
+    # propose: a request to move players, {"room": JID, "players": [JID...]},
+    #          or every player if "players" is left out
+    class RouteBehaviour(CyclicBehaviour):
+        async def run(self):
+            try:
+                message = await self.receive(timeout=LISTEN_TIMEOUT)
+                if not message:
+                    return
+
+                sender = str(message.sender.bare())
+                performative = message.get_metadata("performative")
+
+                if performative == "request":
+                    room = self.agent.assignments.get(sender) or self.agent.pick_room()
+                    self.agent.assignments[sender] = room
+
+                    reply = Message(to=sender)
+                    reply.set_metadata("performative", "agree")
+                    reply.body = json.dumps({"room": room})
+                    await self.send(reply)
+                    self.agent.logger.info("RouteBehaviour: %s assigned to %s", sender, room)
+
+                elif performative == "cancel":
+                    self.agent.assignments.pop(sender, None)
+
+                elif performative == "propose":
+                    order = json.loads(message.body)
+                    players = order.get("players") or list(self.agent.assignments)
+                    for player in players:
+                        await self.agent.move(self, player, order["room"], order.get("index"))
+
+            except Exception as e:
+                self.agent.logger.error("RouteBehaviour: %s", e)
+
+    ### REBALANCEBEHAVIOUR
+    # moves players from the most crowded room to the emptiest until they're
+    # within one of each other (or the crowded one is back under capacity)
+    class RebalanceBehaviour(PeriodicBehaviour):
+        async def run(self):
+            try:
+                while True:
+                    counts = self.agent.occupancy()
+                    fullest = max(counts, key=counts.get)
+                    emptiest = min(counts, key=counts.get)
+                    over = (counts[fullest] - counts[emptiest] > 1 if self.agent.capacity is None 
+                            else counts[fullest] > self.agent.capacity and counts[emptiest] < self.agent.capacity)
+                    if not over:
+                        return
+
+                    player = next(p for p, room in self.agent.assignments.items() if room == fullest)
+                    await self.agent.move(self, player, emptiest)
+            except Exception as e:
+                self.agent.logger.error("RebalanceBehaviour: %s", e)
+
+    async def setup(self):
+        templates = None
+        for performative in ("request", "cancel", "propose"):
+            template = Template()
+            template.set_metadata("performative", performative)
+            templates = template if templates is None else templates | template
+        self.add_behaviour(self.RouteBehaviour(), templates)
+
+        if self.rebalance:
+            self.add_behaviour(self.RebalanceBehaviour(period=REBALANCE_PERIOD))
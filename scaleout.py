@@ -0,0 +1,335 @@
+### SCALE-OUT LAUNCHER
+# runs a headless game (bots only) spread over several processes, and
+# optionally several hosts sharing one XMPP server, so the bots get every core
+# instead of sharing one event loop. all of it is described by a JSON manifest:
+#
+# {
+#   "domain": "localhost",      XMPP domain every agent lives on
+#   "processes": 4,             worker processes on each host
+#   "hosts": 1,                 hosts running this same manifest
+#   "bots": 24,
+#   "rooms": 2,
+#   "workers": 2,               LLM interface workers
+#   "backends": ["http://localhost:11434/v1"],  each worker falls back on the rest
+#   "request_timeout": 80,      seconds one completion attempt may take
+#   "retries": 2,
+#   "hedge": null,              latency percentile to hedge at, null for never
+#   "model": "llama3.1",
+#   "random_pacing": false,
+#   "stable_prefix": false,
+#   "speculate": false,
+#   "stream": false,
+#   "recall": 0,                past chat lines recalled into bot prompts
+#   "cache_size": 0,            completions each worker caches, 0 for none
+#   "cache_path": null,
+#   "keep_alive": null,         e.g. "30m" to have ollama keep the model loaded
+#   "parallel_starts": 8,
+#   "metrics_port": 9108,       each process serves on this plus its slot, 0 for off
+#   "log_level": "INFO",
+#   "heartbeat": 5,             seconds between health reports
+#   "start_delay": 10,          how long hosts other than 0 give the other hosts' 
+#                               services to come up
+#   "duration": 0,              seconds to run for, 0 until interrupted
+#   "stop_on_failure": true     a dead or silent process stops everything
+# }
+#
+# every host works out the same plan from the manifest, and runs its own share
+# of it: python scaleout.py manifest.json --host N. the services (rooms,
+# router, LLM interfaces, scheduler) come up first, then the bots, spread
+# round-robin over every process on every host. the interactive game, with a
+# human player, is still wolf.py
+################################################################################
+from player import PlayerAgent
+from chatroom import ChatRoomAgent
+from router import RoomRouterAgent
+from llminterface import LLMInterfaceAgent, LLMDispatcherAgent, DEFAULT_BASE_URL, KEEP_ALIVE, MAX_CONCURRENT
+from llminterface import REQUEST_TIMEOUT, RETRIES
+from scheduler import SchedulerAgent
+from launcher import start_agents, stop_agents, MAX_PARALLEL_STARTS
+from metrics import REGISTRY, METRICS_PORT
+from eventlog import configure_logging
+import multiprocessing
+import argparse
+import logging
+import asyncio
+import signal
+import queue
+import spade
+import json
+import time
+import os
+
+### SETTINGS
+HEARTBEAT = 5           # seconds between health reports
+MISSED_HEARTBEATS = 3   # reports a process may miss before it's considered dead
+START_DELAY = 10        # seconds hosts other than 0 give remote services to come up
+STOP_TIMEOUT = 30       # seconds a process gets to stop before it's terminated
+
+DEFAULTS = {
+    "domain": "localhost",
+    "processes": os.cpu_count() or 1,
+    "hosts": 1,
+    "bots": 3,
+    "rooms": 1,
+    "workers": 1,
+    "backends": [DEFAULT_BASE_URL],
+    "request_timeout": REQUEST_TIMEOUT,
+    "retries": RETRIES,
+    "hedge": None,
+    "model": "llama3.1",
+    "random_pacing": False,
+    "stable_prefix": False,
+    "speculate": False,
+    "stream": False,
+    "recall": 0,
+    "cache_size": 0,
+    "cache_path": None,
+    "keep_alive": KEEP_ALIVE,
+    "parallel_starts": MAX_PARALLEL_STARTS,
+    "metrics_port": METRICS_PORT,
+    "log_level": "INFO",
+    "heartbeat": HEARTBEAT,
+    "start_delay": START_DELAY,
+    "duration": 0,
+    "stop_on_failure": True,
+}
+
+KINDS = {
+    "room": ChatRoomAgent,
+    "router": RoomRouterAgent,
+    "interface": LLMInterfaceAgent,
+    "dispatcher": LLMDispatcherAgent,
+    "scheduler": SchedulerAgent,
+    "player": PlayerAgent,
+}
+
+def load_manifest(path):
+    with open(path) as f:
+        manifest = {**DEFAULTS, **json.load(f)}
+    unknown = set(manifest) - set(DEFAULTS)
+    if unknown:
+        raise ValueError(f"manifest {path}: unknown settings {sorted(unknown)}")
+    return manifest
+
+### PLAN
+# every agent in the game as a spec (kind, jid, password, kwargs), the same
+# names and wiring as wolf.main. services first, so round-robin spreads the
+# LLM interfaces out as well
+def plan(manifest):
+    domain = manifest["domain"]
+    backends = manifest["backends"]
+    jid = lambda name: f"{name}@{domain}"
+    services = []
+
+    rooms = [jid("village")] + [jid(f"village{i}") for i in range(2, manifest["rooms"]+1)]
+    for i, room in enumerate(rooms, start=1):
+        services.append(("room", room, room.split("@")[0],
+                         {"room_name": "Village" if i == 1 else f"Village {i}"}))
+
+    router = None
+    if len(rooms) > 1:
+        router = jid("router")
+        services.append(("router", router, "router", {"rooms": rooms}))
+
+    interface = {"model": manifest["model"], "cache_size": manifest["cache_size"],
+                 "cache_path": manifest["cache_path"],
+                 "keep_alive": manifest["keep_alive"], "timeout": manifest["request_timeout"],
+                 "retries": manifest["retries"], "hedge": manifest["hedge"]}
+    if manifest["workers"] <= 1:
+        services.append(("interface", jid("ai"), "ai", {**interface, "base_url": backends}))
+    else:
+        workers = [jid(f"ai{i}") for i in range(1, manifest["workers"]+1)]
+        for i, worker in enumerate(workers):
+            first = i % len(backends)
+            services.append(("interface", worker, worker.split("@")[0],
+                             {**interface, "base_url": backends[first:] + backends[:first]}))
+        services.append(("dispatcher", jid("ai"), "ai", {"workers": workers}))
+
+    scheduler = None
+    if not manifest["random_pacing"]:
+        scheduler = jid("scheduler")
+        services.append(("scheduler", scheduler, "scheduler",
+                         {"capacity": max(1, manifest["workers"]) * MAX_CONCURRENT}))
+
+    players = []
+    for i in range(1, manifest["bots"]+1):
+        players.append(("player", jid(f"aiplayer{i}"), f"aiplayer{i}", {
+            "player_interface": jid("ai"), "model": manifest["model"],
+            "scheduler": scheduler, "router": router,
+            "stable_prefix": manifest["stable_prefix"],
+            "speculate": manifest["speculate"], "stream": manifest["stream"],
+            "recall_k": manifest["recall"],
+        }))
+    return services, players, rooms[0]
+
+# deals the specs out over every process on every host, returning the ones
+# for the given slot (host * processes + process)
+def share(specs, slot, slots):
+    return [spec for i, spec in enumerate(specs) if i % slots == slot]
+
+def build(spec, first_room):
+    kind, jid, password, kwargs = spec
+    agent = KINDS[kind](jid, password, **kwargs)
+    if kind == "player":
+        agent.chatroom = first_room # without a router, everyone's in the first room
+    return agent
+
+### HEARTBEAT
+# how many of the process's agents are up, and how late the event loop is 
+# waking up, which is the first thing to suffer when a process has too many
+async def heartbeat(slot, agents, reports, period):
+    loop = asyncio.get_running_loop()
+    while True:
+        before = loop.time()
+        await asyncio.sleep(period)
+        lag = loop.time() - before - period
+        alive = sum(agent.is_alive() for agent in agents)
+        reports.put(("health", slot, os.getpid(), {"alive": alive, "agents": len(agents),
+                                                   "lag": round(lag, 3), "time": time.time()}))
+
+### RUN_PROCESS
+# one worker process: starts its services, says so, waits for every other
+# process's services, then starts its bots. reports its health every
+# heartbeat (starting straight away, since logins can take a while) until 
+# told to stop
+async def run_process(manifest, slot, services, players, first_room, reports, services_up, shutdown):
+    service_agents = [build(spec, first_room) for spec in services]
+    player_agents = [build(spec, first_room) for spec in players]
+    health = asyncio.create_task(heartbeat(slot, service_agents + player_agents, 
+                                           reports, manifest["heartbeat"]))
+
+    if manifest["metrics_port"]:
+        try:
+            await REGISTRY.serve(port=manifest["metrics_port"] + slot)
+        except OSError as e:
+            logging.error(f"scaleout {slot}: metrics endpoint not started: {e}")
+
+    await start_agents(service_agents, manifest["parallel_starts"])
+    reports.put(("services", slot, os.getpid(), len(service_agents)))
+    while not services_up.is_set() and not shutdown.is_set():
+        await asyncio.sleep(0.1)
+    if not shutdown.is_set():
+        await start_agents(player_agents, manifest["parallel_starts"])
+
+    while not shutdown.is_set():
+        await asyncio.sleep(0.5)
+
+    health.cancel()
+    await stop_agents(player_agents)
+    await stop_agents(service_agents)
+    for agent in service_agents:
+        if isinstance(agent, ChatRoomAgent):
+            agent.chat_log.close()
+    await REGISTRY.close()
+    reports.put(("stopped", slot, os.getpid(), None))
+
+def process_main(manifest, slot, services, players, first_room, reports, services_up, shutdown):
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the parent decides when to stop
+    configure_logging(manifest["log_level"])
+    spade.run(run_process(manifest, slot, services, players, first_room, reports, services_up, shutdown))
+
+### SUPERVISE
+# the parent: starts this host's processes, lets the bots go once every local
+# process has its services up (and, on other hosts, once host 0 has had
+# start_delay to get its own up), then logs a health line per heartbeat.
+# an interrupt, the end of duration, or (with stop_on_failure) a process that
+# dies or goes quiet stops them all together
+def supervise(manifest, host):
+    services, players, first_room = plan(manifest)
+    processes = manifest["processes"]
+    slots = processes * manifest["hosts"]
+
+    context = multiprocessing.get_context("spawn")
+    reports = context.Queue()
+    services_up = context.Event()
+    shutdown = context.Event()
+
+    children = {}
+    for process in range(processes):
+        slot = host * processes + process
+        child = context.Process(target=process_main, name=f"wolf-{slot}", args=(
+            manifest, slot, share(services, slot, slots), share(players, slot, slots),
+            first_room, reports, services_up, shutdown))
+        child.start()
+        children[slot] = child
+    logging.info(f"scaleout: host {host} running slots {sorted(children)} of {slots}, "
+                 f"{len(services)} services and {len(players)} bots in total")
+
+    stopping = []
+    signal.signal(signal.SIGINT, lambda *_: stopping.append("interrupted"))
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append("terminated"))
+
+    started = time.monotonic()
+    ready = set()
+    health = {}
+    last_seen = {slot: time.monotonic() for slot in children}
+    timeout = manifest["heartbeat"] * MISSED_HEARTBEATS + manifest["start_delay"]
+    last_report = time.monotonic()
+
+    while not stopping:
+        try:
+            kind, slot, pid, data = reports.get(timeout=1)
+            last_seen[slot] = time.monotonic()
+            if kind == "services":
+                ready.add(slot)
+            elif kind == "health":
+                health[slot] = data
+        except queue.Empty:
+            pass
+
+        now = time.monotonic()
+        if not services_up.is_set() and len(ready) == len(children):
+            if host == 0 or now - started >= manifest["start_delay"]:
+                services_up.set()
+                logging.info(f"scaleout: services up after {now - started:.1f}s, starting bots")
+
+        if now - last_report >= manifest["heartbeat"] and health:
+            last_report = now
+            alive = sum(h["alive"] for h in health.values())
+            agents = sum(h["agents"] for h in health.values())
+            worst = max(health.items(), key=lambda item: item[1]["lag"])
+            logging.info(f"scaleout: {alive}/{agents} agents alive in {len(health)} processes, "
+                         f"worst loop lag {worst[1]['lag']}s (slot {worst[0]})")
+
+        failed = [slot for slot, child in children.items() if not child.is_alive()
+                  or now - last_seen[slot] > timeout]
+        if failed:
+            logging.error(f"scaleout: slots {failed} died or went quiet")
+            if manifest["stop_on_failure"]:
+                stopping.append("failure")
+            else:
+                for slot in failed:
+                    children.pop(slot).join(0)
+                if not children:
+                    stopping.append("no processes left")
+        if manifest["duration"] and now - started >= manifest["duration"]:
+            stopping.append("duration reached")
+
+    logging.info(f"scaleout: stopping ({stopping[0]})")
+    shutdown.set()
+    deadline = time.monotonic() + STOP_TIMEOUT
+    for slot, child in children.items():
+        child.join(max(0, deadline - time.monotonic()))
+        if child.is_alive():
+            logging.warning(f"scaleout: slot {slot} didn't stop in time, terminating")
+            child.terminate()
+            child.join()
+
+### ARGUMENTS
+def parse_args():
+    parser = argparse.ArgumentParser(description="Multi Agent Wolf, spread over processes and hosts")
+    parser.add_argument("manifest", help="JSON manifest describing the game")
+    parser.add_argument("--host", type=int, default=0,
+                        help="which of the manifest's hosts this one is, from 0")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    manifest = load_manifest(args.manifest)
+    if not 0 <= args.host < manifest["hosts"]:
+        raise SystemExit(f"--host must be between 0 and {manifest['hosts'] - 1}")
+    configure_logging(manifest["log_level"])
+    supervise(manifest, args.host)
+
+if __name__ == "__main__":
+    main()
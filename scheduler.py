@@ -0,0 +1,131 @@
+from spade.agent import Agent
+from spade.behaviour import CyclicBehaviour, PeriodicBehaviour
+from spade.template import Template
+from spade.message import Message
+from eventlog import get_logger
+import json
+import time
+
+### SETTINGS
+DEFAULT_CAPACITY = 4    # speaking turns at once, roughly the backend's slots
+TURN_LEASE = 300        # seconds before an unreturned turn is taken back
+IDLE_GAP = 30           # seconds between turns nobody has anything new for
+LISTEN_TIMEOUT = 10
+
+### SCHEDULERAGENT
+# hands out speaking turns, instead of every player sleeping a random amount 
+# after every state. a player asks for a turn once it's got something to react 
+# to (or has been idle a while), and speaks when it gets one. at most capacity 
+# turns run at once, so the model is kept busy but never buried.
+# players reacting to new chat go first, least-recently-served first among 
+# them. a player with nothing new only gets a turn every idle_gap seconds, so a
+# quiet room still has the odd line without the bots talking to themselves
+#
+# ARGUMENTS
+# capacity      - turns allowed at once
+# lease         - seconds a turn may be held before it's reclaimed
+# idle_gap      - minimum seconds between turns granted with no new chat
+#
+# ATTRIBUTES
+# waiting       - JID -> (fresh, requested_at, thread). the grant goes out on
+#                 the request's thread, so a late one can't be mistaken for 
+#                 the answer to a newer request
+# active        - JID -> when the turn was granted
+# last_turn     - JID -> when it last finished a turn
+class SchedulerAgent(Agent):
+    def __init__(self, jid, password, capacity=DEFAULT_CAPACITY, lease=TURN_LEASE,
+                 idle_gap=IDLE_GAP, **kwargs):
+        super().__init__(jid, password, **kwargs)
+        self.capacity = capacity
+        self.lease = lease
+        self.idle_gap = idle_gap
+        self.waiting = {}
+        self.active = {}
+        self.last_turn = {}
+        self.last_idle_grant = 0
+        self.logger = get_logger("sched", self.name)
+
+
+    # who's up next, or None if nobody should go yet
+    def next_in_line(self):
+        if not self.waiting:
+            return None
+
+        player = min(self.waiting, key=lambda jid: (
+            not self.waiting[jid][0], self.last_turn.get(jid, 0), self.waiting[jid][1]))
+
+        fresh = self.waiting[player][0]
+        if not fresh and time.monotonic() - self.last_idle_grant < self.idle_gap:
+            return None
+        return player
+
+    # fills free capacity from the queue
+    async def grant(self, behaviour):
+        while len(self.active) < self.capacity:
+            player = self.next_in_line()
+            if player is None:
+                return
+
+            fresh, _, thread = self.waiting.pop(player)
+            now = time.monotonic()
+            self.active[player] = now
+            if not fresh:
+                self.last_idle_grant = now
+
+            message = Message(to=player, thread=thread)
+            message.set_metadata("performative", "agree")
+            await behaviour.send(message)
+            self.logger.debug("grant: %s (%s/%s active)", player, len(self.active), self.capacity)
+
+    def release(self, player):
+        if self.active.pop(player, None) is not None:
+            self.last_turn[player] = time.monotonic()
+
+    ### TURNBEHAVIOUR
+    # request: join the queue (body says whether there's new chat)
+    # confirm: done speaking
+    # cancel: gave up waiting, or leaving
+    class TurnBehaviour(CyclicBehaviour):
+        async def run(self):
+            try:
+                message = await self.receive(timeout=LISTEN_TIMEOUT)
+                if message:
+                    player = str(message.sender.bare())
+                    performative = message.get_metadata("performative")
+
+                    if performative == "request":
+                        fresh = json.loads(message.body).get("fresh", True) if message.body else True
+                        self.agent.release(player) # asking again means it's done
+                        self.agent.waiting[player] = (fresh, time.monotonic(), message.thread)
+                    elif performative == "confirm":
+                        self.agent.release(player)
+                    elif performative == "cancel":
+                        self.agent.waiting.pop(player, None)
+                        self.agent.release(player)
+
+                await self.agent.grant(self)
+
+            except Exception as e:
+                self.agent.logger.error("TurnBehaviour: %s", e)
+
+    ### LEASEBEHAVIOUR
+    # takes back turns that were never returned, and lets idle turns through
+    # once the gap has passed
+    class LeaseBehaviour(PeriodicBehaviour):
+        async def run(self):
+            now = time.monotonic()
+            for player, granted in list(self.agent.active.items()):
+                if now - granted > self.agent.lease:
+                    self.agent.logger.warning("LeaseBehaviour: reclaimed turn from %s", player)
+                    self.agent.release(player)
+
+            await self.agent.grant(self)
+
+    async def setup(self):
+        templates = None
+        for performative in ("request", "confirm", "cancel"):
+            template = Template()
+            template.set_metadata("performative", performative)
+            templates = template if templates is None else templates | template
+        self.add_behaviour(self.TurnBehaviour(), templates)
+        self.add_behaviour(self.LeaseBehaviour(period=1))
@@ -0,0 +1,99 @@
+from chatlog import encode_entry
+from messagestore import as_json
+import logging
+import asyncio
+import gzip
+import json
+import time
+import os
+
+### SETTINGS
+SNAPSHOT_VERSION = 2
+SNAPSHOT_PERIOD = 60        # seconds between periodic snapshots
+
+### ROOM_STATE
+# a room whose log already lives in a file only needs to say where it is, 
+# otherwise the entries it still has go into the snapshot, along with where
+# they start, so the indexes players saved still point at the same lines
+def room_state(room):
+    state = {"jid": str(room.jid), "length": len(room.chat_log), "log_path": room.chat_log.path}
+    if not room.chat_log.path:
+        state["first_index"] = room.chat_log.first_index
+        state["entries"] = [entry.decode() for entry in room.chat_log[room.chat_log.first_index:]]
+    return state
+
+### PLAYER_STATE
+# everything that would otherwise cost a trip to the model to get back
+def player_state(player):
+    return {
+        "jid": str(player.jid),
+        "player_name": player.player_name,
+        "personality": player.personality,
+        "chatroom": player.chatroom,
+        "chat_index": player.chat_index,
+        "room_indexes": dict(player.room_indexes),
+        "memory": list(player.memory),
+        "summary": player.memory.summary,
+        "folded": list(player.memory.folded),
+        "folded_tokens": player.memory.folded_tokens
+    }
+
+### GATHER
+# copies of the state, so they can be written out while the game carries on
+def gather(rooms, players):
+    return {
+        "version": SNAPSHOT_VERSION,
+        "time": time.time(),
+        "rooms": [room_state(room) for room in rooms],
+        "players": [player_state(player) for player in players]
+    }
+
+### WRITE_SNAPSHOT
+# gzipped JSON, written to a temporary file and swapped in, so a crash halfway
+# through never leaves a broken snapshot behind
+def write_snapshot(path, data):
+    temporary = f"{path}.tmp"
+    with gzip.open(temporary, "wt", compresslevel=5) as f:
+        json.dump(data, f, separators=(",", ":"), default=as_json)
+    os.replace(temporary, path)
+
+def load_snapshot(path):
+    with gzip.open(path, "rt") as f:
+        data = json.load(f)
+    if data.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"snapshot {path} is version {data.get('version')}, expected {SNAPSHOT_VERSION}")
+    return data
+
+### RESTORE
+# puts the saved state back into freshly made (not yet started) agents, matched
+# up by JID. rooms backed by a file recover from it on their own
+def restore(data, rooms, players):
+    saved_rooms = {state["jid"]: state for state in data["rooms"]}
+    for room in rooms:
+        state = saved_rooms.get(str(room.jid))
+        if state and "entries" in state and len(room.chat_log) == 0:
+            if not room.chat_log.path:
+                room.chat_log.start_at(state["first_index"])
+            for entry in state["entries"]:
+                room.chat_log.append(encode_entry(entry))
+
+    saved_players = {state["jid"]: state for state in data["players"]}
+    for player in players:
+        state = saved_players.get(str(player.jid))
+        if state:
+            player.restore(state)
+
+    logging.info(f"snapshot: restored {len(saved_rooms)} rooms and {len(saved_players)} players "
+                 f"from {time.ctime(data['time'])}")
+
+### SNAPSHOT_LOOP
+# runs alongside the game: the state is gathered on the event loop, and the 
+# compressing and writing happens in a thread
+async def snapshot_loop(path, rooms, players, period=SNAPSHOT_PERIOD):
+    while True:
+        await asyncio.sleep(period)
+        try:
+            await asyncio.to_thread(write_snapshot, path, gather(rooms, players))
+            logging.debug(f"snapshot: written to {path}")
+        except Exception as e:
+            logging.error(f"snapshot: writing {path}: {e}")
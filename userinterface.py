@@ -4,11 +4,23 @@ from spade.behaviour import CyclicBehaviour, FSMBehaviour, State
 from spade.template import Template
 from spade.message import Message
 import json
-from player import PlayerAgent
+from player import PlayerAgent, FILLER_PROMPT
+from eventlog import get_logger
+import threading
+import codecs
+import shutil
+import atexit
 import os
-import logging
+import sys
 import asyncio
 
+# posix only, elsewhere the terminal does its own line editing
+try:
+    import termios
+    import tty
+except ImportError:
+    termios = None
+
 ### HELP TEXT
 COMMANDS = '''***COMMANDS***
 /bye             - end the game
@@ -19,6 +31,17 @@ Any other text will be treated as dialogue by the game.
 TIP: press enter to say nothing, and load more dialogue
 '''
 
+### SETTINGS
+INPUT_WAIT = 5      # seconds to wait for typing before letting the game move on
+PROMPT = ">> "
+CLEAR_LINE = "\r\x1b[K"
+LINE_UP = "\x1b[A"
+ERASE = ("\x7f", "\b")
+KILL_LINE = "\x15"     # ctrl-u
+END_OF_INPUT = "\x04"  # ctrl-d
+
+logger = get_logger("ui")
+
 ### PRINT_MESSAGES
 # helper function for display
 def print_messages(msg_log):
@@ -29,6 +52,187 @@ def print_messages(msg_log):
             except:
                 pass #eh
 
+### RENDER_NEW
+# incremental display: prints only the part of msg_log that hasn't been shown
+# yet, and remembers what has. the player sends its whole memory every time,
+# which slides along as the chat goes on, so the new part starts after the 
+# longest run at the start of msg_log that matches the end of what's shown.
+# the new lines go above the input line, which is put back as it was
+def render_new(shown, msg_log, reader):
+    overlap = 0
+    for k in range(min(len(shown), len(msg_log)), 0, -1):
+        if shown[-k:] == msg_log[:k]:
+            overlap = k
+            break
+
+    lines = [msg['content'] for msg in msg_log[overlap:] 
+             if msg.get('role') != 'assistant' and msg.get('content') != FILLER_PROMPT]
+    shown[:] = msg_log
+    if lines:
+        reader.show_above("\n".join(str(line) for line in lines))
+    return len(lines)
+
+### INPUTREADER
+# one stdin reader for the life of the agent, instead of a new executor thread
+# per prompt. lines land in a queue as they're typed, so the user can type 
+# while new chat is being printed, and the next prompt picks the line up 
+# straight away. None means stdin closed.
+# on posix the event loop watches stdin itself, and reads whatever's there 
+# without blocking, so a pasted block of lines all makes it into the queue
+# instead of waiting in a buffer nobody looks at. on a terminal it also does
+# the line editing (echo, backspace, ctrl-u), so it always knows what's been
+# typed and can put it back after printing chat over it. elsewhere a single
+# daemon thread does blocking reads
+#
+# ATTRIBUTES
+# typed         - the line being typed, not yet entered
+# status        - the line shown just above the input (a reply being 
+#                 generated), None if there isn't one
+class InputReader:
+    def __init__(self):
+        self.lines = asyncio.Queue()
+        self.loop = None
+        self.closed = False
+        self.typed = ""
+        self.status = None
+        self.echo = False
+        self.saved_mode = None
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        try:
+            fd = sys.stdin.fileno()
+            self.loop.add_reader(fd, self.on_readable)
+        except (NotImplementedError, AttributeError, ValueError, OSError):
+            threading.Thread(target=self.read_forever, daemon=True).start()
+            return
+
+        if termios is not None and os.isatty(fd):
+            self.saved_mode = termios.tcgetattr(fd)
+            tty.setcbreak(fd)
+            atexit.register(self.restore_mode)
+            self.echo = True
+
+    def on_readable(self):
+        data = os.read(sys.stdin.fileno(), 4096)
+        if not data:
+            self.loop.remove_reader(sys.stdin.fileno())
+            self.end()
+            return
+        for char in self.decoder.decode(data):
+            self.feed(char)
+
+    # one character of input, echoed back on a terminal
+    def feed(self, char):
+        if char in "\r\n":
+            if char == "\r" and not self.echo:
+                return
+            line, self.typed = self.typed, ""
+            self.write("\n")
+            self.lines.put_nowait(line)
+        elif not self.echo:
+            self.typed += char
+        elif char in ERASE:
+            if self.typed:
+                self.typed = self.typed[:-1]
+                self.write("\b \b")
+        elif char == KILL_LINE:
+            self.write("\b \b" * len(self.typed))
+            self.typed = ""
+        elif char == END_OF_INPUT:
+            if not self.typed:
+                self.loop.remove_reader(sys.stdin.fileno())
+                self.end()
+        elif char.isprintable():
+            self.typed += char
+            self.write(char)
+
+    # stdin closed: whatever was typed without a newline still counts
+    def end(self):
+        if self.typed:
+            self.lines.put_nowait(self.typed)
+            self.typed = ""
+        self.closed = True
+        self.lines.put_nowait(None)
+
+    def write(self, text):
+        if self.echo:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+    # prints text above the input line, and puts the input line back
+    def show_above(self, text):
+        sys.stdout.write(self.clear() + text + "\n" + PROMPT + self.typed)
+        sys.stdout.flush()
+
+    # shows text on its own line just above the input, in place of what was
+    # there before. None takes it away
+    def show_status(self, text):
+        output = self.clear()
+        if text is not None:
+            width = shutil.get_terminal_size().columns - 1
+            if len(text) > width:
+                text = "..." + text[-(width - 3):]
+            output += text + "\n"
+        self.status = text
+        sys.stdout.write(output + PROMPT + self.typed)
+        sys.stdout.flush()
+
+    # what takes the input line (and the status line, if any) off the screen
+    def clear(self):
+        if self.status is None:
+            return CLEAR_LINE
+        self.status = None
+        return CLEAR_LINE + LINE_UP + CLEAR_LINE
+
+    def read_forever(self):
+        while True:
+            line = sys.stdin.readline()
+            if not line:
+                self.closed = True
+            self.loop.call_soon_threadsafe(self.lines.put_nowait, line.rstrip("\n") if line else None)
+            if not line:
+                return
+
+    # the next line typed, or None if nothing comes within timeout
+    async def read(self, timeout=None):
+        try:
+            return await asyncio.wait_for(self.lines.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def stop(self):
+        if self.loop is not None:
+            try:
+                self.loop.remove_reader(sys.stdin.fileno())
+            except (NotImplementedError, AttributeError, ValueError, OSError):
+                pass
+        self.restore_mode()
+
+    # gives the terminal its own line editing back
+    def restore_mode(self):
+        if self.saved_mode is not None:
+            termios.tcsetattr(sys.stdin.fileno(), termios.TCSADRAIN, self.saved_mode)
+            self.saved_mode = None
+
+### STREAMBEHAVIOUR
+# incrementally, a reply that's still being generated is shown on the line 
+# above the input, over whatever partial reply was there before. the finished
+# message gets printed properly with the rest of the new chat, and an 
+# abandoned one just disappears
+class StreamBehaviour(CyclicBehaviour):
+    async def run(self):
+        try:
+            partial = await self.receive(timeout=2)
+            if partial and self.agent.incremental:
+                if partial.get_metadata("stage") == "abort":
+                    self.agent.reader.show_status(None)
+                else:
+                    self.agent.reader.show_status(json.loads(partial.body)["content"])
+        except Exception as e:
+            logger.error("StreamBehaviour: %s", e)
+
 ### STATES
 NAMING_STATE = "UI_NAME_STATE"
 ACTION_STATE = "UI_ACTION_STATE"
@@ -38,7 +242,8 @@ ACTION_STATE = "UI_ACTION_STATE"
 # it goes down
 class UIFSMBehaviour(FSMBehaviour):
     async def on_end(self):
-        logging.info(f"FSM finished at state {self.current_state}")
+        logger.info("FSM finished at state %s", self.current_state)
+        self.agent.reader.stop()
         self.kill(10)
         await self.agent.stop()
 
@@ -50,12 +255,16 @@ class NamingState(State):
             request = await self.receive(timeout=300)
             if request:
                 data = json.loads(request.body)
-                logging.info(f"received request: {data}")
+                logger.info("received request: %s", data)
                 print("Please choose a name.", flush=True)
 
                 verify_input = False
                 while not verify_input:
-                    kb_in = await asyncio.get_event_loop().run_in_executor(None, input, ">> ")
+                    kb_in = await self.agent.read_line(">> ")
+                    if kb_in is None:
+                        self.kill(exit_code=10)
+                        await self.agent.stop()
+                        return
                     if ' ' in kb_in or '/' in kb_in:
                         print("Please choose a name without spaces or the '/' symbol.", flush=True)
                     else:
@@ -66,35 +275,51 @@ class NamingState(State):
                 completion = {"content": kb_in}
                 response.body = json.dumps(completion)
                 await self.send(response)
-                logging.info(f"sent message: {completion}")
+                logger.info("sent message: %s", completion)
 
                 #os.system('clear||cls')
                 self.set_next_state(ACTION_STATE)
             else:
-                logging.info("timeout - no messages")
+                logger.info("timeout - no messages")
                 print("timeout")
         except Exception as e:
-            logging.exception(e)
+            logger.exception("%s", e)
             self.kill(exit_code=1)
 
 ### ACTIONSTATE
 # the process of how the user actually interacts with the environment
+# incrementally, only the new chat is printed, and if nothing's been typed 
+# within input_wait the game is told the user said nothing, so it can fetch 
+# more chat in the meantime. whatever the user was typing is kept for the next
+# prompt. otherwise the screen is cleared and redrawn, and the game waits
 class ActionState(State):
     async def run(self):
         try:
             req = await self.receive(timeout=2)
             if req:
                 data = json.loads(req.body)
-                logging.debug(f"userInterface: received request: {data}")
+                logger.debug("userInterface: received request: %s", data)
 
-                os.system('clear||cls')
-                print_messages(data)
-                await asyncio.sleep(5)
+                if self.agent.incremental:
+                    render_new(self.agent.shown, data, self.agent.reader)
+                else:
+                    os.system('clear||cls')
+                    print_messages(data)
+                    await asyncio.sleep(5)
                 res = Message(to=str(req.sender.bare()))
 
                 verify_input = False
                 while not verify_input:
-                    kb_in = await asyncio.get_event_loop().run_in_executor(None, input, ">> ")
+                    if self.agent.incremental:
+                        kb_in = await self.agent.reader.read(self.agent.input_wait)
+                        if kb_in is None and not self.agent.reader.closed:
+                            kb_in = "" # nothing typed yet, let the chat move on
+                    else:
+                        kb_in = await self.agent.read_line(">> ")
+                    if kb_in is None:
+                        self.kill(exit_code=10)
+                        await self.agent.stop()
+                        return
                     if kb_in.startswith("/"):
                         if kb_in == "/help":
                             print(COMMANDS)
@@ -112,27 +337,58 @@ class ActionState(State):
 
                 completion = { "role": "assistant", "content": kb_in }
                 res.body = json.dumps(completion)
-                print("\nLoading... .. .", flush=True)
+                if not self.agent.incremental:
+                    print("\nLoading... .. .", flush=True)
+                elif kb_in:
+                    sys.stdout.write(CLEAR_LINE + PROMPT + self.agent.reader.typed)
+                    sys.stdout.flush()
                 await self.send(res)
 
-                logging.info(f"sent message: {res.body}")
+                logger.info("sent message: %s", res.body)
             else:
-                logging.info("UI: timeout - no messages")
+                logger.info("UI: timeout - no messages")
         except Exception as e:
-            logging.exception(e)
+            logger.exception("%s", e)
             self.kill(exit_code=1)
 
 ### USERINTERFACEAGENT
 # holds it all together
+#
+# ARGUMENTS
+# incremental   - print only new chat and read input in the background, 
+#                 instead of clearing and redrawing the screen each prompt
+# input_wait    - incrementally, how long to wait for typing each prompt
+#
+# ATTRIBUTES
+# reader        - the InputReader behind every prompt
+# shown         - the chat currently on screen, for incremental rendering
 class userInterfaceAgent(Agent):
+    def __init__(self, jid, password, incremental=True, input_wait=INPUT_WAIT, **kwargs):
+        super().__init__(jid, password, **kwargs)
+        self.incremental = incremental
+        self.input_wait = input_wait
+        self.reader = InputReader()
+        self.shown = []
+
+    # a whole line, however long it takes, printing the prompt first
+    async def read_line(self, prompt):
+        sys.stdout.write(prompt)
+        sys.stdout.flush()
+        return await self.reader.read()
+
     async def setup(self):
+        self.reader.start()
+
         self.game_loop = UIFSMBehaviour()
         self.game_loop.add_state(name=NAMING_STATE, state=NamingState(), initial=True)
         self.game_loop.add_state(name=ACTION_STATE, state=ActionState())
         self.game_loop.add_transition(source=NAMING_STATE, dest=ACTION_STATE)
         self.game_loop.add_transition(source=ACTION_STATE, dest=ACTION_STATE)
 
-        self.add_behaviour(self.game_loop)
+        stream_template = Template()
+        stream_template.set_metadata("channel", "stream")
+        self.add_behaviour(self.game_loop, ~stream_template)
+        self.add_behaviour(StreamBehaviour(), stream_template)
 
 ### TESTING
 async def main():
@@ -6,23 +6,67 @@
 #
 # COMMAND-LINE ARGUMENTS:
 # num_ai    - controls the number of bots spawned
+# --workers - how many LLM interface workers to pool behind ai@localhost
+# --backend - a model server URL, repeat it to spread workers across servers 
+#             (each worker falls back on the others)
+# --request-timeout - seconds one attempt at a completion may take
+# --retries - further attempts after a failed one, on the next healthy backend
+# --hedge   - latency percentile past which a duplicate goes to another backend
+# --cache-size - completions each worker caches, 0 (the default) for no cache
+# --cache-path - sqlite file the response cache persists to
+# --chat-log - file the room's chat log is kept in, and recovered from
+# --rooms   - how many village rooms to split the players over
+# --parallel-starts - how many agents may connect/register at the same time
+# --local   - run everything on the in-process message bus, no XMPP server
+# --random-pacing - have bots sleep randomly between states, instead of taking
+#             turns from the scheduler
+# --stable-prefix - keep bot prompts append-only between planned resets, so the
+#             model server can reuse its prompt cache
+# --classic-ui - clear and redraw the screen for every prompt, instead of 
+#             printing only new chat while reading input in the background
+# --stream  - show bot replies in the room as they're being generated
+# --recall  - past chat lines recalled into each bot prompt (needs numpy)
+# --speculate - have bots draft their next reply while they wait for a turn
+# --keep-alive - how long an ollama server keeps the model loaded (e.g. 30m),
+#             not sent unless given
+# --metrics-port - where prometheus-style metrics are served, 0 for nowhere
+# --metrics-dump - where the metrics snapshot is written at shutdown
+# --log-level - what gets written to the console (DEBUG, INFO, WARNING...)
+# --log     - a per-category level, e.g. --log player=WARNING (categories: 
+#             player, room, llm, sched, ui)
+# --log-ring - recent events kept and dumped when an error is logged, 0 for none
+# --snapshot - file the game state is saved to, periodically and at shutdown
+# --snapshot-every - seconds between periodic snapshots
+# --resume  - snapshot to pick the bots (and rooms) back up from
 ################################################################################
 from userinterface import userInterfaceAgent, COMMANDS
 from player import PlayerAgent
 from chatroom import ChatRoomAgent
-from llminterface import LLMInterfaceAgent
+from router import RoomRouterAgent
+from llminterface import LLMInterfaceAgent, LLMDispatcherAgent, DEFAULT_BASE_URL, KEEP_ALIVE, REQUEST_TIMEOUT, RETRIES, MAX_CONCURRENT
+from scheduler import SchedulerAgent
+from launcher import start_agents, stop_agents, MAX_PARALLEL_STARTS
+from bus import in_process
+from metrics import REGISTRY, METRICS_PORT
+from eventlog import configure_logging, RING_SIZE
+from recall import RECALL_K
+from snapshot import gather, write_snapshot, load_snapshot, restore, snapshot_loop, SNAPSHOT_PERIOD
+import argparse
 import logging
 import asyncio
 import spade
-import sys
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s",
     level=logging.INFO
 )
+for noisy in ("spade.Agent", "spade.behaviour", "SPADE", "spade.Message", "spade.Template", "spade.Web"):
+    logging.getLogger(noisy).setLevel(logging.WARNING)
 
 ### SETTINGS AND JUNK
 DEFAULT_AI = 3
+DEFAULT_WORKERS = 1
+METRICS_DUMP = "metrics_snapshot.json"
 WELCOME_MESSAGE = '''
 ***Welcome to Multi Agent Wolf (MAW) Version 0.1***
 You... won't actually be playing a game of Werewolf, but all the others in the 
@@ -32,38 +76,162 @@ experience.
 LOADING_MESSAGE = '''Loading... Please be patient for the prompt :-)
 '''
 
+### ARGUMENTS
+def parse_args():
+    parser = argparse.ArgumentParser(description="Multi Agent Wolf")
+    parser.add_argument("num_ai", type=int, nargs="?", default=DEFAULT_AI,
+                        help="number of bots spawned")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="number of LLM interface workers")
+    parser.add_argument("--backend", action="append", default=[],
+                        help="model server URL, may be given more than once")
+    parser.add_argument("--request-timeout", type=float, default=REQUEST_TIMEOUT,
+                        help="seconds one completion attempt may take")
+    parser.add_argument("--retries", type=int, default=RETRIES,
+                        help="retries on failure, each on the next healthy backend")
+    parser.add_argument("--hedge", type=float, default=None, metavar="PERCENTILE",
+                        help="send a duplicate to another backend past this latency percentile")
+    parser.add_argument("--cache-size", type=int, default=0,
+                        help="completions cached per worker, off by default")
+    parser.add_argument("--cache-path", default=None,
+                        help="sqlite file to keep cached completions across runs")
+    parser.add_argument("--chat-log", default=None,
+                        help="append-only file backing the room's chat log")
+    parser.add_argument("--rooms", type=int, default=1,
+                        help="rooms the players are split over by the router")
+    parser.add_argument("--parallel-starts", type=int, default=MAX_PARALLEL_STARTS,
+                        help="agents started concurrently")
+    parser.add_argument("--local", action="store_true",
+                        help="use the in-process message bus instead of XMPP")
+    parser.add_argument("--random-pacing", action="store_true",
+                        help="pace bots with random sleeps instead of the turn scheduler")
+    parser.add_argument("--stable-prefix", action="store_true",
+                        help="append-only bot prompts, for server-side prompt caching")
+    parser.add_argument("--classic-ui", action="store_true",
+                        help="redraw the whole chat for every prompt")
+    parser.add_argument("--stream", action="store_true",
+                        help="stream bot replies to the room and the UI as they're generated")
+    parser.add_argument("--recall", type=int, nargs="?", default=0, const=RECALL_K, metavar="K",
+                        help="relevant past chat lines added to each bot prompt, 0 for none")
+    parser.add_argument("--speculate", action="store_true",
+                        help="bots draft replies as soon as new chat arrives")
+    parser.add_argument("--keep-alive", default=KEEP_ALIVE,
+                        help="how long ollama keeps the model loaded, e.g. 30m (not sent by default)")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="local port for the metrics endpoint, 0 to turn it off")
+    parser.add_argument("--metrics-dump", default=METRICS_DUMP,
+                        help="file the metrics snapshot is written to at shutdown")
+    parser.add_argument("--log-level", default="INFO",
+                        help="console log level")
+    parser.add_argument("--log", action="append", default=[], metavar="CATEGORY=LEVEL",
+                        help="log level for one category")
+    parser.add_argument("--log-ring", type=int, default=RING_SIZE,
+                        help="recent events dumped when an error is logged")
+    parser.add_argument("--snapshot", default=None,
+                        help="file the game state is snapshotted to")
+    parser.add_argument("--snapshot-every", type=float, default=SNAPSHOT_PERIOD,
+                        help="seconds between periodic snapshots")
+    parser.add_argument("--resume", default=None,
+                        help="snapshot to resume the bots and rooms from")
+    return parser.parse_args()
+
 ### MAIN
 async def main():
-
-    num_ai = DEFAULT_AI
-    try:
-        num_ai = sys.argv[i]
-    except:
-        pass
+    args = parse_args()
+    configure_logging(args.log_level, dict(setting.split("=", 1) for setting in args.log),
+                      ring_size=args.log_ring)
+    num_ai = args.num_ai
+    backends = args.backend or [DEFAULT_BASE_URL]
     ai_list = []
+    worker_list = []
+
+    # on the bus, every agent is swapped for its in-process version
+    UI, Room, Router, Interface, Dispatcher, Scheduler, Player = (
+        userInterfaceAgent, ChatRoomAgent, RoomRouterAgent, LLMInterfaceAgent, 
+        LLMDispatcherAgent, SchedulerAgent, PlayerAgent)
+    if args.local:
+        UI, Room, Router, Interface, Dispatcher, Scheduler, Player = map(in_process, 
+            (UI, Room, Router, Interface, Dispatcher, Scheduler, Player))
 
     print(WELCOME_MESSAGE)
     print(COMMANDS)
     print(f"There are {num_ai} AI in the room with you.")
     print(LOADING_MESSAGE)
 
-    useragent = userInterfaceAgent("user@localhost", "user")
-    await useragent.start(auto_register=True)
+    useragent = UI("user@localhost", "user", incremental=not args.classic_ui)
+    # the first room keeps the old address, and with more than one a router 
+    # decides who sits where
+    room_list = [Room("village@localhost", "village", "Village", log_path=args.chat_log)]
+    for i in range(2, args.rooms+1):
+        room_list.append(Room(f"village{i}@localhost", f"village{i}", f"Village {i}",
+                              log_path=f"{args.chat_log}.{i}" if args.chat_log else None))
 
-    room = ChatRoomAgent("village@localhost", "village", "Village")
-    await room.start(auto_register=True)
+    router = None
+    if len(room_list) > 1:
+        router = Router("router@localhost", "router", [str(room.jid) for room in room_list])
 
-    ai = LLMInterfaceAgent("ai@localhost", "ai")
-    await ai.start(auto_register=True)
+    # a single worker answers on ai@localhost directly, otherwise a 
+    # dispatcher takes that address and spreads the load over the pool
+    # each worker starts on its own backend, with the rest as fallbacks
+    reliability = {"timeout": args.request_timeout, "retries": args.retries, "hedge": args.hedge}
+    if args.workers <= 1:
+        ai = Interface("ai@localhost", "ai", base_url=backends, 
+                               cache_size=args.cache_size, cache_path=args.cache_path,
+                               keep_alive=args.keep_alive, **reliability)
+    else:
+        for i in range(1, args.workers+1):
+            first = (i-1) % len(backends)
+            worker = Interface(f"ai{i}@localhost", f"ai{i}", 
+                                       base_url=backends[first:] + backends[:first],
+                                       cache_size=args.cache_size, cache_path=args.cache_path,
+                                       keep_alive=args.keep_alive, **reliability)
+            worker_list.append(worker)
+
+        ai = Dispatcher("ai@localhost", "ai", [str(w.jid) for w in worker_list])
+
+    # turns are handed out as fast as the interfaces can take them
+    scheduler = None
+    if not args.random_pacing:
+        scheduler = Scheduler("scheduler@localhost", "scheduler", 
+                              capacity=max(1, args.workers) * MAX_CONCURRENT)
 
     for i in range(1,num_ai+1):
-        aiplayer = PlayerAgent(f"aiplayer{i}@localhost", f"aiplayer{i}", "ai@localhost")
-        await aiplayer.start(auto_register=True)
-        
+        aiplayer = Player(f"aiplayer{i}@localhost", f"aiplayer{i}", "ai@localhost",
+                          scheduler=str(scheduler.jid) if scheduler else None,
+                          stable_prefix=args.stable_prefix,
+                          speculate=args.speculate, stream=args.stream, recall_k=args.recall,
+                          router=str(router.jid) if router else None)
         ai_list.append(aiplayer)
 
-    player = PlayerAgent("userplayer@localhost", "userplayer", "user@localhost", wait_period=0, wait_variance=0)
-    await player.start(auto_register=True)
+    player = Player("userplayer@localhost", "userplayer", "user@localhost", wait_period=0, wait_variance=0,
+                    router=str(router.jid) if router else None, stream=args.stream)
+
+    # the room and the interfaces come up first, so the players have someone
+    # to talk to as soon as they start
+    services = ([useragent, ai] + room_list + worker_list + 
+                [agent for agent in (scheduler, router) if agent])
+    players = ai_list + [player]
+
+    # only the bots are brought back, the human gets asked for a name again
+    if args.resume:
+        try:
+            restore(load_snapshot(args.resume), room_list, ai_list)
+        except (OSError, ValueError) as e:
+            logging.error(f"not resuming from {args.resume}: {e}")
+
+    if args.metrics_port:
+        try:
+            await REGISTRY.serve(port=args.metrics_port)
+        except OSError as e:
+            logging.error(f"metrics endpoint not started: {e}")
+
+    await start_agents(services, args.parallel_starts)
+    await start_agents(players, args.parallel_starts)
+
+    snapshots = None
+    if args.snapshot:
+        snapshots = asyncio.create_task(snapshot_loop(args.snapshot, room_list, ai_list, 
+                                                      args.snapshot_every))
 
     while not useragent.game_loop.is_killed():
         try:
@@ -71,13 +239,18 @@ async def main():
         except KeyboardInterrupt:
             break
     
-    await useragent.stop()
-    await player.stop()
-    await room.stop()
-    await ai.stop()
+    if snapshots:
+        snapshots.cancel()
+    await stop_agents(players)
+    if args.snapshot:
+        write_snapshot(args.snapshot, gather(room_list, ai_list))
+    await stop_agents(services)
+    for room in room_list:
+        room.chat_log.close()
 
-    for aiplayer in ai_list:
-        await aiplayer.stop()
+    await REGISTRY.close()
+    if args.metrics_dump:
+        REGISTRY.dump(args.metrics_dump)
 
     print("Bye!")
 